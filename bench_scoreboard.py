@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+"""Benchmark the overlay and the play ingest of generate_scoreboard.py on a recorded game
+
+The game is replayed from an archive (see generate_scoreboard.py archive)
+without network access, ffmpeg or a stream.
+
+Usage:
+    bench_scoreboard.py [options] [<archive>]
+    bench_scoreboard.py (-h | --help)
+
+Options:
+    -h --help             Show this help message and exit
+    --font=<file>         Font used to draw the overlay [default: /usr/share/fonts/truetype/dejavu/DejaVuSans.ttf]
+    --repeat=<n>          Number of replays of the game per benchmark [default: 3]
+    --engine=<engine>     Overlay engine, pil or numpy [default: pil]
+    --output=<file>       Write the results in file instead of stdout
+    --compare=<file>      Print the change of the results against a previous output
+"""
+
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from docopt import docopt
+
+ARGS = docopt(__doc__)
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+ARCHIVE = ARGS['<archive>'] or os.path.join(DIRECTORY, 'fixtures', 'sample_game.wbsc')
+WORKING_DIR = tempfile.mkdtemp(prefix='bench_scoreboard_')
+CONFIG = '''[baseball]
+website_url = http://127.0.0.1:9
+working_dir = %(working_dir)s
+main_rtmp_stream = rtmp://127.0.0.1/bench
+mode = replay
+replay_mode = sequence
+font = %(font)s
+photo_workers = 0
+overlay_engine = %(engine)s
+'''
+GAME_INFO = {
+    'home_primary_color': '#0a14c8',
+    'home_secondary_color': '#c8c800',
+    'away_primary_color': '#dcdcdc',
+    'away_secondary_color': '#000000',
+}
+
+sys.path.insert(0, DIRECTORY)
+import generate_scoreboard as gs  # noqa: E402
+import PIL  # noqa: E402
+import requests  # noqa: E402
+
+config_file = os.path.join(WORKING_DIR, 'bench.ini')
+with open(config_file, 'w') as f:
+    f.write(CONFIG % {'working_dir': WORKING_DIR, 'font': ARGS['--font'], 'engine': ARGS['--engine']})
+gs.configure(gs.Settings.read(config_file))
+
+
+class OfflineAdapter(requests.adapters.BaseAdapter):
+    """Fail every request, photos and logos fall back to the default images"""
+
+    def send(self, request, **kwargs):
+        raise requests.ConnectionError('no network in benchmark: %s' % request.url)
+
+    def close(self):
+        pass
+
+
+def make_offline_session():
+    session = requests.Session()
+    session.mount('http://', OfflineAdapter())
+    session.mount('https://', OfflineAdapter())
+    return session
+
+
+class NullWriter:
+    def write(self, image):
+        pass
+
+    def write_frame(self, frame):
+        pass
+
+
+def new_game(game_id):
+    game = gs.Game(dict(GAME_INFO, live_score_id=game_id), mode='replay', replay_mode='sequence', stream=False)
+    game.photo_loaders.join()
+    game.replay.stop()
+    game.overlay_writer = NullWriter()
+    return game
+
+
+def update(game, data):
+    game.update_game(data)
+
+
+def update_and_render(game, data):
+    game.update_game(data)
+    game.make_overlay()
+
+
+def replay(game_id, step):
+    """Replay the whole game, step(game, data) is called for every play"""
+    game = new_game(game_id)
+    try:
+        for play in game.archive.plays:
+            game.current_play = play
+            step(game, game.archive.read(play))
+    finally:
+        game.archive.close()
+        game.release()
+
+
+def run(game_id, name, call, prepare=update):
+    """Latency and allocations of call(game, data) for every play of the game
+
+    prepare(game, data) is called before and not measured.
+    """
+    times = []
+
+    def timed(game, data):
+        if prepare:
+            prepare(game, data)
+        start = time.perf_counter()
+        call(game, data)
+        times.append(time.perf_counter() - start)
+
+    for _ in range(int(ARGS['--repeat'])):
+        replay(game_id, timed)
+
+    allocated = []
+    peaks = []
+
+    def traced(game, data):
+        if prepare:
+            prepare(game, data)
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        call(game, data)
+        current, peak = tracemalloc.get_traced_memory()
+        allocated.append(current - before)
+        peaks.append(peak - before)
+
+    tracemalloc.start()
+    try:
+        replay(game_id, traced)
+    finally:
+        tracemalloc.stop()
+
+    times.sort()
+    result = {
+        'calls': len(times),
+        'mean_ms': statistics.mean(times) * 1000,
+        'median_ms': statistics.median(times) * 1000,
+        'p95_ms': times[int(len(times) * 0.95)] * 1000,
+        'max_ms': times[-1] * 1000,
+        'retained_kib': statistics.mean(allocated) / 1024,
+        'peak_kib': max(peaks) / 1024,
+    }
+    print('%-20s %8.3f ms mean %8.3f ms p95 %10.1f KiB peak' % (name, result['mean_ms'], result['p95_ms'], result['peak_kib']), file=sys.stderr)
+    return result
+
+
+def ingest(game_id):
+    """Throughput of reading and applying every play of the game"""
+    game = new_game(game_id)
+    game.boxscore = {}
+    try:
+        start = time.perf_counter()
+        for play in game.archive.plays:
+            game.update_game(game.archive.read(play))
+        duration = time.perf_counter() - start
+    finally:
+        game.archive.close()
+        game.release()
+    result = {
+        'plays': len(game.archive.plays),
+        'seconds': duration,
+        'plays_per_second': len(game.archive.plays) / duration,
+    }
+    print('%-20s %8.0f plays/s' % ('ingest', result['plays_per_second']), file=sys.stderr)
+    return result
+
+
+def compare(results, previous):
+    for name, result in sorted(results['results'].items()):
+        if name not in previous['results']:
+            continue
+        before = previous['results'][name]['mean_ms']
+        print('%-20s %8.3f ms -> %8.3f ms %+6.1f%%' % (name, before, result['mean_ms'], (result['mean_ms'] / before - 1) * 100))
+    before = previous['ingest']['plays_per_second']
+    after = results['ingest']['plays_per_second']
+    print('%-20s %8.0f /s  -> %8.0f /s  %+6.1f%%' % ('ingest', before, after, (after / before - 1) * 100))
+
+
+def version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=DIRECTORY, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    gs.make_session = make_offline_session
+    archive = gs.GameArchive(ARCHIVE)
+    game_id = archive.game_id
+    archive.close()
+    os.makedirs(gs.settings.archive_dir)
+    shutil.copyfile(ARCHIVE, gs.GameArchive.path_for(game_id))
+    writer = gs.OverlayFileWriter(WORKING_DIR)
+
+    results = {
+        'version': version(),
+        'archive': os.path.basename(ARCHIVE),
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'repeat': int(ARGS['--repeat']),
+        'engine': ARGS['--engine'],
+        'results': {
+            'update_game': run(game_id, 'update_game', update, prepare=None),
+            'get_scorebug': run(game_id, 'get_scorebug', lambda game, data: game.get_scorebug()),
+            'get_current_batter': run(game_id, 'get_current_batter', lambda game, data: game.get_current_batter()),
+            'get_lineup': run(game_id, 'get_lineup', lambda game, data: game.get_lineup(game.home, gs.HOME_NAME)),
+            'make_overlay': run(game_id, 'make_overlay', lambda game, data: game.make_overlay()),
+            'png_write': run(game_id, 'png_write', lambda game, data: writer.write(game.overlay), prepare=update_and_render),
+        },
+        'ingest': ingest(game_id),
+        # tracemalloc only sees python objects, the pixels of the images are in max_rss_kib
+        'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    output = json.dumps(results, indent=2)
+    if ARGS['--output']:
+        with open(ARGS['--output'], 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if ARGS['--compare']:
+        with open(ARGS['--compare']) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        shutil.rmtree(WORKING_DIR, ignore_errors=True)
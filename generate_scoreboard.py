@@ -2,71 +2,248 @@
 
 """Usage:
     generate_scoreboard.py <config_file>
+    generate_scoreboard.py archive <config_file> <live_score_id>...
     generate_scoreboard.py (-h | --help)
 
 Options:
     -h --help             Show this help message and exit
 """
+import time
+
+# measured from here when /proc is not available
+IMPORT_TIME = time.monotonic()
+
+if __name__ == '__main__':
+    # the service runs on gevent, patched before anything imports socket or ssl
+    from gevent import monkey
+    monkey.patch_all()
+
+import bisect
+import functools
+import gc
+import hashlib
+import json
+import multiprocessing
 import subprocess
 import os
 import signal
 import shutil
+import socket
+import sqlite3
 import sys
-import time
+import struct
+import zlib
 from PIL import Image, ImageDraw, ImageFont, ImageOps
 try:
-    import face_recognition
     import numpy
-except:
-    face_recognition = None
+except ImportError:
     numpy = None
 from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
 from docopt import docopt
 import configparser
+import contextlib
 from datetime import datetime
 import gevent
-from gevent import monkey
+import gevent.event
+import gevent.pool
+import gevent.queue
+from gevent.fileobject import FileObjectPosix
+from gevent.pywsgi import WSGIServer
 
 import logging
 
-monkey.patch_all()
 import requests
 
-ARGS = docopt(__doc__)
-
 logger = logging.getLogger(__name__)
 
-config = configparser.ConfigParser()
-config.read(ARGS['<config_file>'])
-
-WEBSITE_URL = config.get('baseball', 'website_url')
-WORKING_DIR = config.get('baseball', 'working_dir')
 TIMEOUT = 30
 HOME_NAME = 'home'
 AWAY_NAME = 'away'
 BASE_URL = 'https://game.wbsc.org/gamedata'
-LATEST_PLAY_URL = '%s/%%s/latest.json' % (BASE_URL)
-PLAY_URL = '%s/%%s/play%%s.json' % (BASE_URL)
+# on settings.wbsc_url
+LATEST_PLAY_URL = '%s/%s/latest.json'
+PLAY_URL = '%s/%s/play%s.json'
 HEADERS = {"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36"}
+# never downloaded, the bases are drawn by the scorebug, so it is left out of the asset cache
 FIELD_IMAGE = 'https://static.wbsc.org/public/wbsc/images/baseball-field.svg'
 DEFAULT_IMAGE_URL = 'https://static.wbsc.org/assets/images/default-player.jpg'
 # STATS https://www.wbsc.org/api/v1/player/stats?tab=charts&fedId=143&eventId=2115&roundId=all&gameId=all&pId=649920&teamId=29254
-INPUT_CAMERA_STREAM_FIELD1 = config.has_option('baseball', 'input_stream_1') and config.get('baseball', 'input_stream_1')
-INPUT_CAMERA_STREAM_FIELD2 = config.has_option('baseball', 'input_stream_2') and config.get('baseball', 'input_stream_2')
 FINE_TUNE_CAMERA_FIELD1 = 'rotate=0.06,crop=2100:980:100:100,'
 
 FINE_TUNE_CAMERA_FIELD2 = ''
 
-FONTS = '/usr/share/fonts/X11/Type1/NimbusSans-Regular.pfb'
-
-MAIN_STREAM = config.get('baseball', 'main_rtmp_stream')
-BACKUP_STREAM = config.has_option('baseball', 'backup_rtmp_stream') and config.get('baseball', 'backup_rtmp_stream')
-
-LOGFILE = config.has_option('baseball', 'logfile') and config.get('baseball', 'logfile')
 INPUT_RESOLUTION = (1920, 1080)
+OVERLAY_FRAMERATE = 3
+# every segment of the broadcast is encoded at this rate with a keyframe every STREAM_KEYINT frames
+STREAM_FRAMERATE = 30
+STREAM_KEYINT = 2 * STREAM_FRAMERATE
+RESTART_BACKOFF_RESET = 60
+# the local ports of field n are shifted by FIELD_PORT_OFFSET * (n - 1)
+FIELD_PORT_OFFSET = 100
+# a greenlet sleeping LOOP_PROBE_INTERVAL measures how long the event loop is blocked
+LOOP_PROBE_INTERVAL = 0.1
+LOOP_BLOCKED_EVENT = 0.25
+# -progress keys of ffmpeg published as gauges
+FFMPEG_PROGRESS = (
+    ('frame', 'ffmpeg_frames'),
+    ('fps', 'ffmpeg_fps'),
+    ('bitrate', 'ffmpeg_bitrate_kbits'),
+    ('speed', 'ffmpeg_speed'),
+    ('dup_frames', 'ffmpeg_dup_frames'),
+    ('drop_frames', 'ffmpeg_drop_frames'),
+)
 
 PHOTO_WIDTH = 470
 
+SCOREBUG_BG_COLOR = (0, 0, 0, 180)
+SCOREBUG_TEXT_COLOR = (255, 255, 255, 200)
+SCOREBUG_BASE_COLOR = (255, 255, 255, 170)
+SCOREBUG_RUNNER_COLOR = (255, 255, 128, 255)
+
+
+class Settings:
+    """Options of the [baseball] section, Settings() gives the defaults"""
+
+    def __init__(self, parser=None):
+        if parser is None:
+            parser = configparser.ConfigParser()
+        if not parser.has_section('baseball'):
+            parser.add_section('baseball')
+        self.parser = parser
+        section = parser['baseball']
+        self.website_url = section.get('website_url')
+        # game data of wbsc, replaced by the stand-in of soak_scoreboard.py in tests
+        self.wbsc_url = section.get('wbsc_url', BASE_URL)
+        self.working_dir = section.get('working_dir', '.')
+        self.mode = section.get('mode', 'live')
+        self.replay_mode = section.get('replay_mode', 'realtime')
+        self.intro_file = section.get('intro_file')
+        self.end_file = section.get('end_file')
+        # image shown while no live encoder is healthy, black otherwise
+        self.standby_file = section.get('standby_file')
+        self.test_time = section.get('test_time')
+        self.font = section.get('font', '/usr/share/fonts/X11/Type1/NimbusSans-Regular.pfb')
+        self.main_stream = section.get('main_rtmp_stream')
+        self.backup_stream = section.get('backup_rtmp_stream')
+        self.logfile = section.get('logfile')
+        # file: overlay.png re-read by ffmpeg, pipe: raw RGBA frames written to ffmpeg
+        self.overlay_output = section.get('overlay_output', 'file')
+        # pil: overlay composed in a PIL image, numpy: composed in preallocated NumPy frame buffers
+        self.overlay_engine = section.get('overlay_engine', 'pil')
+        # live polling interval of latest.json, shortened when plays are coming fast
+        self.poll_min_interval = section.getfloat('poll_min_interval', 0.5)
+        self.poll_max_interval = section.getfloat('poll_max_interval', 5)
+        self.poll_timeout = section.getfloat('poll_timeout', 5)
+        # seconds the pre-game overlay is shown before the first play, between two checks of a game not
+        # started yet and during which the final score stays on the stream
+        self.game_start_delay = section.getfloat('game_start_delay', 10)
+        self.game_retry_interval = section.getfloat('game_retry_interval', 30)
+        self.game_end_delay = section.getfloat('game_end_delay', 120)
+        self.archive_dir = section.get('archive_dir', os.path.join(self.working_dir, 'archives'))
+        # play:<number> or inning:<inning> (5, TOP 5 or BOT 5) to start the replay from
+        self.replay_start = section.get('replay_start')
+        self.replay_speed = section.getfloat('replay_speed', 1.0)
+        # render the overlays of all the plays of a replay ahead of time in worker processes
+        self.replay_prerender = section.getboolean('replay_prerender', False)
+        # render the likely next states of the scorebug and the batter card while waiting for the next play,
+        # each layer keeps its render_cache_size most recently used renders
+        self.render_ahead = section.getboolean('render_ahead', True)
+        self.render_cache_size = section.getint('render_cache_size', 16)
+        # one CPU is left to the service and the encoders of the game
+        self.prerender_workers = section.getint('prerender_workers', max(1, (os.cpu_count() or 1) - 1))
+        # the encoded stream is sent once per RTMP output to local udp ports starting at this one
+        self.relay_port = section.getint('relay_port', 23000)
+        # an ffmpeg whose -progress counters do not move for stall_timeout seconds is killed and restarted
+        self.stall_timeout = section.getfloat('stall_timeout', 10)
+        # restarts wait restart_backoff doubled on every failure up to restart_backoff_max,
+        # reset once the process ran RESTART_BACKOFF_RESET seconds
+        self.restart_backoff = section.getfloat('restart_backoff', 1)
+        self.restart_backoff_max = section.getfloat('restart_backoff_max', 30)
+        # a second encoder kept running to take over the stream when the first one fails,
+        # the encoders, the slate and the videos send to the stream switch on standby_port to standby_port + 3
+        self.warm_standby = section.getboolean('warm_standby', False)
+        self.standby_port = section.getint('standby_port', self.relay_port + 10)
+        # both cameras connected to the encoder, the camera of the game is switched without restarting it
+        self.hot_camera_switch = section.getboolean('hot_camera_switch', False)
+        # games streamed side by side, one per field
+        self.max_games = section.getint('max_games', 1)
+        # CPUs of the node given to the encoders when games run side by side, each encoder of a game is pinned
+        # on encoder_cpus of them, by default the games share the budget equally
+        self.cpu_budget = section.getint('cpu_budget', os.cpu_count() or 1)
+        self.encoder_cpus = section.getint('encoder_cpus', 0)
+        # metrics served on http://127.0.0.1:metrics_port/metrics, timings appended as json lines to metrics_events
+        self.metrics_port = section.getint('metrics_port', 0)
+        self.metrics_events = section.get('metrics_events')
+        # photos and logos prefetched when the game is initialized
+        self.asset_concurrency = section.getint('asset_concurrency', 8)
+        self.asset_timeout = section.getfloat('asset_timeout', 5)
+        self.asset_deadline = section.getfloat('asset_deadline', 10)
+        self.asset_cache_dir = section.get('asset_cache_dir', os.path.join(self.working_dir, 'assets'))
+        self.asset_cache_size = section.getint('asset_cache_size', 200) * 1024 * 1024
+        # cached assets younger than this are used without revalidation
+        self.asset_max_age = section.getint('asset_max_age', 24 * 3600)
+        self.headshot_cache_dir = section.get('headshot_cache_dir', os.path.join(self.working_dir, 'headshots'))
+        self.photo_workers = section.getint('photo_workers', 1)
+        # decoded logos and headshots kept for the next games, least recently used ones dropped above this
+        self.image_pool_size = section.getint('image_pool_size', 64) * 1024 * 1024
+        # season and game stats of the players, kept across games and restarts
+        self.stats_db = section.get('stats_db', os.path.join(self.working_dir, 'stats.sqlite'))
+        # poll, sse, longpoll or webhook, how the games flagged on the website are discovered
+        self.discovery = section.get('discovery', 'poll')
+        # polling interval while a game is flagged, backing off up to discovery_max_interval otherwise
+        self.discovery_min_interval = section.getfloat('discovery_min_interval', 5)
+        self.discovery_max_interval = section.getfloat('discovery_max_interval', 60)
+        # a game missing from the website for discovery_grace seconds is ended
+        self.discovery_grace = section.getfloat('discovery_grace', 10)
+        # the webhook only listens on other interfaces than the loopback when it requires discovery_token
+        self.discovery_webhook_host = section.get('discovery_webhook_host', '127.0.0.1')
+        self.discovery_webhook_port = section.getint('discovery_webhook_port', 23080)
+        self.discovery_token = section.get('discovery_token')
+
+    @classmethod
+    def read(cls, path):
+        parser = configparser.ConfigParser()
+        parser.read(path)
+        return cls(parser)
+
+    def get(self, option, fallback=None):
+        return self.parser.get('baseball', option, fallback=fallback)
+
+    def __getstate__(self):
+        # the parser is rebuilt from its options in the worker processes
+        state = dict(self.__dict__)
+        state['parser'] = {section: dict(self.parser[section]) for section in self.parser.sections()}
+        return state
+
+    def __setstate__(self, state):
+        parser = configparser.ConfigParser()
+        parser.read_dict(state['parser'])
+        self.__dict__.update(state, parser=parser)
+
+
+settings = Settings()
+
+
+@functools.lru_cache(maxsize=None)
+def get_font(size):
+    return ImageFont.truetype(settings.font, size)
+
+
+@functools.lru_cache(maxsize=4096)
+def fit_font(text, max_width, max_size):
+    # binary search of the biggest font below max_size rendering text narrower than max_width
+    low, high = 1, max_size - 1
+    size = 1
+    while low <= high:
+        middle = (low + high) // 2
+        if get_font(middle).getlength(text) < max_width:
+            size = middle
+            low = middle + 1
+        else:
+            high = middle - 1
+    return get_font(size)
+
 def hex2rgb(hex_color):
     if not hex_color:
         return False
@@ -83,7 +260,686 @@ def get_text_color(background_color):
         return (255, 255, 255)
 
 
+def make_session(pool_maxsize=None):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize or settings.asset_concurrency)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def parse_current_games(current_score):
+    """Games to stream from /game/current_score, a single game or one per field in 'games'"""
+    return [game for game in current_score.get('games', [current_score]) if game.get('game')]
+
+
+class Discovery:
+    """Games flagged on the website, polled and pushed through sse, longpoll or webhook"""
+
+    def __init__(self, session=None):
+        self.session = session or make_session()
+        self.games = []
+        # number of answers of the website, a waiter is woken up by every new one
+        self.updates = 0
+        self.updated = None
+        self.event = gevent.event.Event()
+        self.refresh = gevent.event.Event()
+        self.headers = {}
+        self.pushed = False
+        self.greenlets = []
+        self.server = None
+
+    def start(self):
+        if self.greenlets:
+            return
+        self.greenlets.append(gevent.spawn(self.run_poll))
+        if settings.discovery == 'sse':
+            self.greenlets.append(gevent.spawn(self.run_sse))
+        elif settings.discovery == 'webhook':
+            host = settings.discovery_webhook_host
+            if host not in ('127.0.0.1', 'localhost', '::1') and not settings.discovery_token:
+                logger.error('The discovery webhook is not started on %s without discovery_token, '
+                             'games are discovered by polling', host)
+                return
+            self.server = WSGIServer((host, settings.discovery_webhook_port), self.app, log=None)
+            self.server.start()
+            self.pushed = True
+
+    def wait(self, seen, timeout=None):
+        """(updates, games) after the update number seen, unchanged if timeout expires first"""
+        if self.updates <= seen:
+            self.event.wait(timeout)
+        return self.updates, self.games
+
+    def publish(self, games, source):
+        if games != self.games:
+            logger.info('Current games from %s: %s', source, games)
+            METRICS.inc('discovery_changes_total', source=source)
+        self.games = games
+        self.updates += 1
+        self.updated = time.monotonic()
+        event, self.event = self.event, gevent.event.Event()
+        event.set()
+
+    def poll(self):
+        """Fetch the games if they changed, return True when they did"""
+        params = {}
+        if settings.discovery == 'longpoll':
+            params['wait'] = int(settings.discovery_max_interval)
+        with METRICS.time('wbsc_request_seconds', request='current_score'):
+            response = self.session.get(f'{settings.website_url}/game/current_score', params=params,
+                                        headers=self.headers, timeout=settings.discovery_max_interval + 30)
+        if response.status_code == 304:
+            self.publish(self.games, 'poll')
+            return False
+        response.raise_for_status()
+        games = parse_current_games(response.json())
+        self.headers = {}
+        if response.headers.get('ETag'):
+            self.headers['If-None-Match'] = response.headers['ETag']
+        if response.headers.get('Last-Modified'):
+            self.headers['If-Modified-Since'] = response.headers['Last-Modified']
+        changed = games != self.games
+        self.publish(games, 'poll')
+        return changed
+
+    def run_poll(self):
+        interval = settings.discovery_min_interval
+        while True:
+            start = time.monotonic()
+            self.refresh.clear()
+            try:
+                changed = self.poll()
+            except (requests.RequestException, ValueError):
+                logger.exception('Could not get current score')
+                METRICS.inc('wbsc_errors_total', request='current_score')
+                changed = False
+            if self.games or changed:
+                # a flagged game is checked every few seconds to notice its end
+                interval = settings.discovery_min_interval
+            elif self.pushed:
+                interval = settings.discovery_max_interval
+            else:
+                interval = min(interval * 2, settings.discovery_max_interval)
+            if settings.discovery == 'longpoll' and time.monotonic() - start >= settings.discovery_min_interval:
+                # the website held the request, ask again at once
+                interval = 0
+            self.refresh.wait(interval)
+
+    def run_sse(self):
+        failures = 0
+        while True:
+            try:
+                response = self.session.get(f'{settings.website_url}/game/current_score/events', stream=True,
+                                            headers={'Accept': 'text/event-stream'},
+                                            timeout=(10, settings.discovery_max_interval * 2))
+                response.raise_for_status()
+                self.pushed = True
+                failures = 0
+                data = []
+                for line in response.iter_lines(decode_unicode=True):
+                    if line.startswith('data:'):
+                        data.append(line[5:].strip())
+                    elif not line and data:
+                        self.publish(parse_current_games(json.loads('\n'.join(data))), 'sse')
+                        data = []
+            except (requests.RequestException, ValueError) as e:
+                logger.info('Discovery events interrupted: %s', e)
+            self.pushed = False
+            failures += 1
+            gevent.sleep(min(settings.restart_backoff * 2 ** failures, settings.discovery_max_interval))
+
+    def app(self, environ, start_response):
+        if environ['PATH_INFO'] != '/discovery' or environ['REQUEST_METHOD'] != 'POST':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'not found']
+        if settings.discovery_token and environ.get('HTTP_X_DISCOVERY_TOKEN') != settings.discovery_token:
+            start_response('403 Forbidden', [('Content-Type', 'text/plain')])
+            return [b'forbidden']
+        # the notification only triggers a poll, the games always come from /game/current_score
+        METRICS.inc('discovery_webhooks_total')
+        self.refresh.set()
+        start_response('204 No Content', [])
+        return []
+
+    def stop(self):
+        gevent.killall(self.greenlets)
+        if self.server:
+            self.server.stop()
+
+
+class Field:
+    """Camera of a field and where its game is streamed, the options of field n are suffixed with _n"""
+
+    def __init__(self, camera, number, fine_tune=''):
+        suffix = '' if number == 1 else '_%s' % number
+        self.camera = camera
+        self.number = number
+        self.input_stream = settings.get('input_stream_%s' % number)
+        self.fine_tune = fine_tune
+        self.working_dir = settings.get('working_dir' + suffix, os.path.join(settings.working_dir, camera))
+        self.main_stream = settings.get('main_rtmp_stream' + suffix, settings.main_stream)
+        self.backup_stream = settings.get('backup_rtmp_stream' + suffix, settings.backup_stream)
+        self.relay_port = settings.relay_port + FIELD_PORT_OFFSET * (number - 1)
+        self.standby_port = settings.standby_port + FIELD_PORT_OFFSET * (number - 1)
+
+
+# built by configure()
+FIELDS = {}
+
+
+def get_field(game_info):
+    return FIELDS['camera1'] if game_info.get('camera') == 'camera1' else FIELDS['camera2']
+
+
+class CpuBudget:
+    """CPUs of the node shared by the encoders of the games running side by side"""
+
+    def __init__(self, cpus):
+        self.free = list(cpus)
+
+    def allocate(self, count):
+        """count CPUs, None if not enough are free"""
+        if count > len(self.free):
+            return None
+        cpus, self.free = self.free[:count], self.free[count:]
+        return cpus
+
+    def release(self, cpus):
+        self.free = sorted(self.free + cpus)
+
+
+def process_uptime():
+    """Seconds since the launch of the process (since the import without /proc)"""
+    try:
+        with open('/proc/self/stat') as f:
+            # fields after the command name, starttime is the 22nd field
+            start = int(f.read().rpartition(')')[2].split()[19])
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - start / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, AttributeError):
+        return time.monotonic() - IMPORT_TIME
+
+
+class Metrics:
+    """Counters, gauges and timings exposed in the Prometheus text format"""
+
+    def __init__(self, events_file=None):
+        self.events_file = events_file
+        self.events = None
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def unset(self, name, **labels):
+        self.gauges.pop((name, tuple(sorted(labels.items()))), None)
+
+    def observe(self, name, seconds, event=True, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        timing = self.timings.setdefault(key, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+        if event:
+            self.event(name, seconds=round(seconds, 6), **labels)
+
+    def startup(self, stage):
+        """Seconds from the launch of the process to stage, recorded once"""
+        key = ('startup_seconds', (('stage', stage),))
+        if key not in self.gauges:
+            self.gauges[key] = process_uptime()
+            logger.info('Startup: %s after %.2fs', stage, self.gauges[key])
+
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def event(self, name, **fields):
+        if not self.events_file:
+            return
+        if not self.events:
+            self.events = open(self.events_file, 'a', buffering=1)
+        self.events.write(json.dumps(dict(time=round(time.time(), 3), event=name, **fields)) + '\n')
+
+    def render(self):
+        def labels(items, **extra):
+            items = items + tuple(extra.items())
+            return '{%s}' % ','.join('%s="%s"' % item for item in items) if items else ''
+
+        lines = []
+        for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+            for name in sorted(set(key[0] for key in values)):
+                lines.append('# TYPE %s %s' % (name, kind))
+                lines += ['%s%s %s' % (name, labels(key[1]), value) for key, value in sorted(values.items()) if key[0] == name]
+        for name in sorted(set(key[0] for key in self.timings)):
+            lines.append('# TYPE %s summary' % name)
+            for key, timing in sorted(self.timings.items()):
+                if key[0] == name:
+                    lines.append('%s_count%s %s' % (name, labels(key[1]), timing[0]))
+                    lines.append('%s_sum%s %s' % (name, labels(key[1]), timing[1]))
+                    lines.append('%s%s %s' % (name, labels(key[1], quantile='1'), timing[2]))
+                    timing[2] = 0.0
+        return '\n'.join(lines) + '\n'
+
+    def app(self, environ, start_response):
+        if environ['PATH_INFO'] != '/metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'not found\n']
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+        return [self.render().encode()]
+
+    def serve(self, port):
+        WSGIServer(('127.0.0.1', port), self.app, log=None).start()
+        gevent.spawn(self.probe_loop)
+
+    def probe_loop(self):
+        """Time during which no greenlet could run because one was blocking the loop"""
+        while True:
+            start = time.monotonic()
+            gevent.sleep(LOOP_PROBE_INTERVAL)
+            blocked = max(0.0, time.monotonic() - start - LOOP_PROBE_INTERVAL)
+            self.observe('loop_blocked_seconds', blocked, event=blocked > LOOP_BLOCKED_EVENT)
+
+
+METRICS = Metrics()
+
+
+class AssetCache:
+    """Disk cache of logos and photos, revalidated with ETag / Last-Modified after max_age"""
+
+    def __init__(self, directory, max_size, max_age):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode()).hexdigest())
+
+    def read(self, url):
+        path = self.path(url)
+        try:
+            with open(path + '.json') as f:
+                meta = json.load(f)
+            with open(path, 'rb') as f:
+                content = f.read()
+        except (OSError, ValueError):
+            return None, None
+        # the modification time of the content is the last access for the LRU eviction
+        os.utime(path)
+        return meta, content
+
+    def write(self, url, meta, content=None):
+        path = self.path(url)
+        # several processes can share the cache
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        if content is not None:
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, path + '.json')
+
+    def get(self, session, url, timeout=None):
+        meta, content = self.read(url)
+        if meta and time.time() - meta['checked'] < self.max_age:
+            return content
+        headers = {}
+        if meta and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            response = session.get(url, headers=headers, timeout=timeout or settings.asset_timeout)
+            if meta and response.status_code == 304:
+                meta['checked'] = time.time()
+                self.write(url, meta)
+                return content
+            response.raise_for_status()
+        except requests.RequestException:
+            if meta:
+                logger.info('Could not revalidate %s, using cached version', url)
+                return content
+            raise
+        meta = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'checked': time.time(),
+        }
+        self.write(url, meta, response.content)
+        self.evict()
+        return response.content
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if '.' in name:
+                continue
+            stat = os.stat(os.path.join(self.directory, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+        size = sum(entry[1] for entry in entries)
+        for mtime, entry_size, name in sorted(entries):
+            if size <= self.max_size:
+                break
+            for path in [name, name + '.json']:
+                try:
+                    os.remove(os.path.join(self.directory, path))
+                except OSError:
+                    pass
+            size -= entry_size
+
+
+# built by configure()
+ASSETS = None
+
+
+@functools.lru_cache(maxsize=None)
+def load_face_recognition():
+    """face_recognition, None if not installed, slow to import so only the photo workers do"""
+    try:
+        import face_recognition
+    except Exception:
+        return None
+    return face_recognition
+
+
+def load_image(source):
+    image = Image.open(source)
+    image.load()
+    return image
+
+
+def has_face_recognition():
+    return load_face_recognition() is not None
+
+
+def make_headshot(content):
+    """Circle cropped player photo centered on the face as PNG, run in the photo process pool"""
+    image = Image.open(BytesIO(content))
+    width, height = image.size
+    image = image.resize((PHOTO_WIDTH, int(PHOTO_WIDTH * height / width)))
+    face_locations = []
+    face_recognition = load_face_recognition()
+    if face_recognition:
+        face_locations = face_recognition.face_locations(numpy.array(image.convert("RGB")))
+
+    width, height = image.size
+    if face_locations:
+        mask = Image.new("L", image.size, 0)
+        top, right, bottom, left = face_locations[0]
+        face_center_x = (left + right) // 2
+        face_center_y = (top + bottom) // 2
+        radius = min(face_center_x, width - face_center_x, face_center_y, height - face_center_y)
+        ellipse = ( face_center_x - radius, face_center_y - radius,
+                    face_center_x + radius, face_center_y + radius)
+        left = face_center_x - radius
+        upper = face_center_y - radius
+        right = face_center_x + radius
+        lower = face_center_y + radius
+    else:
+        size = (PHOTO_WIDTH, PHOTO_WIDTH)
+        mask = Image.new('L', size, 0)
+        ellipse = (0, 0) + size
+    draw = ImageDraw.Draw(mask)
+    draw.ellipse(ellipse, fill=255)
+    image = ImageOps.fit(image, mask.size, centering=(0.5, 0.5))
+    image.putalpha(mask)
+    if face_locations:
+        image = image.crop((left, upper, right, lower))
+        image = image.resize((PHOTO_WIDTH, PHOTO_WIDTH))
+    output = BytesIO()
+    image.save(output, 'PNG')
+    return output.getvalue(), bool(face_locations)
+
+
+class PhotoProcessor:
+    """Build player headshots in worker processes, cached on disk by url and content hash"""
+
+    def __init__(self, cache_dir, workers=1):
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.pool = None
+        # url: headshot file of the photo processed last
+        self.paths = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def cache_path(self, url, content):
+        return os.path.join(self.cache_dir, '%s-%s.png' % (
+            hashlib.sha1(url.encode()).hexdigest()[:16], hashlib.sha1(content).hexdigest()[:16]))
+
+    def headshot(self, url, content):
+        path = self.cache_path(url, content)
+        if not os.path.exists(path):
+            if not self.workers:
+                headshot, face_found = make_headshot(content)
+            else:
+                headshot, face_found = self.start().submit(make_headshot, content).result()
+            if not face_found:
+                logger.info('no face found for %s', url)
+            tmp_path = '%s.%s.tmp' % (path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(headshot)
+            os.replace(tmp_path, path)
+        self.paths[url] = path
+        return IMAGES.get(path, functools.partial(load_image, path))
+
+    def start(self):
+        if not self.pool:
+            # spawned workers do not inherit the greenlets of the service
+            self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self.pool
+
+    def warm_up(self):
+        """Start the workers and import face_recognition in them before the first photo"""
+        if self.workers:
+            pool = self.start()
+            for future in [pool.submit(has_face_recognition) for _ in range(self.workers)]:
+                future.result()
+        METRICS.startup('photos')
+
+    def shutdown(self):
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+
+# built by configure()
+PHOTOS = None
+
+
+def image_bytes(image):
+    return image.width * image.height * len(image.getbands()) if image else 0
+
+
+def resident_memory():
+    """Resident set size of the process in bytes"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class ImagePool:
+    """Decoded logos and headshots shared by the games within budget bytes"""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        # key: image, in order of use
+        self.images = {}
+
+    def get(self, key, load):
+        if key in self.images:
+            image = self.images[key] = self.images.pop(key)
+            return image
+        image = load()
+        self.images[key] = image
+        self.size += image_bytes(image)
+        while self.size > self.budget and len(self.images) > 1:
+            self.size -= image_bytes(self.images.pop(next(iter(self.images))))
+        METRICS.set('image_pool_bytes', self.size)
+        return image
+
+
+# built by configure()
+IMAGES = None
+
+# boxscore keys of the season line of a player, the game line adds the pitching ones
+SEASON_STATS = ('AB', 'H', 'DOUBLE', 'TRIPLE', 'HR', 'BB', 'HBP', 'SF')
+GAME_STATS = ('PA',) + SEASON_STATS + ('SO', 'PITCHES', 'STRIKES', 'BALLS')
+
+
+class StatsStore:
+    """Stats of the players in SQLite, the season line is the latest SEASON of wbsc plus the current game"""
+
+    def __init__(self, path):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # a play only changes a few rows, they are not synced to disk one by one
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        columns = ', '.join(key.lower() for key in GAME_STATS)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS season (event_id TEXT, player_id INTEGER, team_id INTEGER, %s, '
+                            'PRIMARY KEY (event_id, player_id))' % ', '.join(key.lower() for key in SEASON_STATS))
+            self.db.execute('CREATE TABLE IF NOT EXISTS game (event_id TEXT, game_id INTEGER, player_id INTEGER, '
+                            'team_id INTEGER, %s, PRIMARY KEY (event_id, game_id, player_id))' % columns)
+            self.db.execute('CREATE INDEX IF NOT EXISTS season_team ON season (event_id, team_id)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS game_player ON game (event_id, player_id)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS game_team ON game (event_id, team_id, game_id)')
+        # (event_id, game_id, player_id): derived line
+        self.lines = {}
+
+    def update(self, event_id, game_id, entries):
+        """Store the changed boxscore entries of a game"""
+        event_id = str(event_id)
+        with self.db:
+            for entry in entries:
+                player_id = entry.get('playerid')
+                if entry.get('SEASON'):
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO season VALUES (?, ?, ?%s)' % (', ?' * len(SEASON_STATS)),
+                        (event_id, player_id, entry.get('teamid')) + stat_values(entry['SEASON'], SEASON_STATS))
+                self.db.execute(
+                    'INSERT OR REPLACE INTO game VALUES (?, ?, ?, ?%s)' % (', ?' * len(GAME_STATS)),
+                    (event_id, game_id, player_id, entry.get('teamid')) + stat_values(entry, GAME_STATS))
+                self.lines.pop((event_id, game_id, player_id), None)
+
+    def line(self, event_id, game_id, player_id):
+        """Season line of a player up to the current play of the game"""
+        key = (str(event_id), game_id, player_id)
+        if key not in self.lines:
+            self.lines[key] = self.derive(*key)
+        return self.lines[key]
+
+    def forget(self, event_id):
+        """Drop the derived lines of an event from memory"""
+        for key in [key for key in self.lines if key[0] == str(event_id)]:
+            del self.lines[key]
+
+    def export(self, event_id):
+        """Rows of an event by table, to seed the store of another process"""
+        return {table: self.db.execute('SELECT * FROM %s WHERE event_id = ?' % table, (str(event_id),)).fetchall()
+                for table in ('season', 'game')}
+
+    def seed(self, rows):
+        with self.db:
+            for table, values in rows.items():
+                if values:
+                    self.db.executemany('INSERT OR REPLACE INTO %s VALUES (%s)' % (table, ', '.join('?' * len(values[0]))),
+                                        values)
+
+    def derive(self, event_id, game_id, player_id):
+        season = self.db.execute('SELECT %s FROM season WHERE event_id = ? AND player_id = ?' % (
+            ', '.join('TOTAL(%s)' % stat.lower() for stat in SEASON_STATS)), (event_id, player_id)).fetchone()
+        games = self.db.execute('SELECT %s FROM game WHERE event_id = ? AND game_id = ? AND player_id = ?' % (
+            ', '.join('TOTAL(%s)' % stat.lower() for stat in GAME_STATS)), (event_id, game_id, player_id)).fetchone()
+        line = {stat.lower(): int(value) for stat, value in zip(GAME_STATS, games)}
+        for stat, value in zip(SEASON_STATS, season):
+            line[stat.lower()] += int(value)
+        ab, h, bb, hbp, sf = line['ab'], line['h'], line['bb'], line['hbp'], line['sf']
+        line['avg'] = h / ab if ab else 0.0
+        line['obp'] = (h + bb + hbp) / (ab + bb + hbp + sf) if ab + bb + hbp + sf else 0.0
+        line['slg'] = (h + line['double'] + 2 * line['triple'] + 3 * line['hr']) / ab if ab else 0.0
+        line['strike_pct'] = 100.0 * line['strikes'] / line['pitches'] if line['pitches'] else 0.0
+        return line
+
+    def close(self):
+        self.db.close()
+
+
+def stat_values(data, keys):
+    values = []
+    for key in keys:
+        try:
+            values.append(int(data.get(key) or 0))
+        except (TypeError, ValueError):
+            values.append(0)
+    return tuple(values)
+
+
+# built by configure()
+STATS = None
+
+
+def configure(new_settings):
+    """Run with new_settings, the caches, the photo workers and the fields follow them"""
+    global settings, ASSETS, PHOTOS, IMAGES, STATS, FIELDS
+    settings = new_settings
+    get_font.cache_clear()
+    fit_font.cache_clear()
+    METRICS.events_file = settings.metrics_events
+    ASSETS = AssetCache(settings.asset_cache_dir, settings.asset_cache_size, settings.asset_max_age)
+    if PHOTOS:
+        PHOTOS.shutdown()
+    PHOTOS = PhotoProcessor(settings.headshot_cache_dir, settings.photo_workers)
+    IMAGES = ImagePool(settings.image_pool_size)
+    if STATS:
+        STATS.close()
+    STATS = StatsStore(settings.stats_db)
+    FIELDS = {
+        'camera1': Field('camera1', 1, FINE_TUNE_CAMERA_FIELD1),
+        'camera2': Field('camera2', 2, FINE_TUNE_CAMERA_FIELD2),
+    }
+
+
+# player attribute, boxscore key and default value
+PLAYER_STATS = (
+    ('pa', 'PA', None),
+    ('ab', 'AB', None),
+    ('r', 'R', None),
+    ('h', 'H', None),
+    ('rbi', 'RBI', None),
+    ('bb', 'BB', None),
+    ('so', 'SO', None),
+    ('double', 'DOUBLE', None),
+    ('triple', 'TRIPLE', None),
+    ('hr', 'HR', None),
+    ('sf', 'SF', None),
+    ('hbp', 'HBP', None),
+    ('sb', 'SB', None),
+    ('cs', 'CS', None),
+    ('pitches', 'PITCHES', 0),
+    ('strikes', 'STRIKES', 0),
+    ('balls', 'BALLS', 0),
+)
+
+
 class Player:
+    __slots__ = ('team', 'game', 'id', 'team_id', 'name', 'firstname', 'lastname', 'image_url', 'image',
+                 'lineupcode', 'batting_order', 'position') + tuple(stat[0] for stat in PLAYER_STATS)
+
     def __init__(self, game, team, player_data, lineupcode):
         self.team = team
         self.game = game
@@ -93,121 +949,118 @@ class Player:
         self.firstname = player_data.get('firstname')
         self.lastname = player_data.get('lastname')
         self.image_url = player_data.get('image')
-        if self.image_url == DEFAULT_IMAGE_URL:
-            self.image = None
-        else:
-            self.image = Image.open(BytesIO(self.game.session.get(self.image_url).content))
-            self.create_circle_mask()
-        self.stats = player_data.get('SEASON')
+        # placeholder avatar until the headshot is ready
+        self.image = None
+        if self.image_url != DEFAULT_IMAGE_URL:
+            game.photo_loaders.spawn(self.load_image)
         self.update(player_data, lineupcode)
 
-    def create_circle_mask(self):
-        width, height = self.image.size
-        self.image = self.image.resize((PHOTO_WIDTH, int(PHOTO_WIDTH * height / width)))
-        if self.image.mode != "RGB":
-            image = self.image.convert("RGB")
-        else:
-            image = self.image
-        if face_recognition:
-            image_np = numpy.array(image)
-            face_locations = face_recognition.face_locations(image_np)
-
-        width, height = self.image.size
-        if face_locations:
-            mask = Image.new("L", self.image.size, 0)
-            top, right, bottom, left = face_locations[0]
-            face_center_x = (left + right) // 2
-            face_center_y = (top + bottom) // 2
-            radius = min(face_center_x, width - face_center_x, face_center_y, height - face_center_y)
-            ellipse = ( face_center_x - radius, face_center_y - radius,
-                        face_center_x + radius, face_center_y + radius)
-            left = face_center_x - radius
-            upper = face_center_y - radius
-            right = face_center_x + radius
-            lower = face_center_y + radius
-        else:
-            logger.info('no face found for %s', self.name)
-            size = (PHOTO_WIDTH, PHOTO_WIDTH)
-            mask = Image.new('L', size, 0)
-            ellipse = (0, 0) + size
-        draw = ImageDraw.Draw(mask)
-        draw.ellipse(ellipse, fill=255)
-        self.image = ImageOps.fit(self.image, mask.size, centering=(0.5, 0.5))
-        self.image.putalpha(mask)
-        if face_locations:
-            self.image = self.image.crop((left, upper, right, lower))
-            self.image = self.image.resize((PHOTO_WIDTH, PHOTO_WIDTH))
+    def load_image(self):
+        try:
+            path = self.game.headshots.get(self.image_url)
+            if path:
+                self.image = IMAGES.get(path, functools.partial(load_image, path))
+                return
+            # the download is dropped once decoded, a photo missed by the prefetch is downloaded again here
+            content = self.game.assets.pop(self.image_url, None)
+            if content is None:
+                content = ASSETS.get(self.game.session, self.image_url)
+            self.image = PHOTOS.headshot(self.image_url, content)
+        except Exception:
+            logger.exception('Could not load photo of %s', self.name)
+            return
+        if getattr(self.game, 'batter', None) is self and not self.game.force_end:
+            self.game.make_overlay()
 
     def update(self, data, lineupcode):
-        self.batting_order = lineupcode[2]
-        self.position = data.get('POS')
-        if not self.position and data.get('PITCHIP'):
-            self.position = 'P'
-        self.pa = data.get('PA')
-        self.ab = data.get('AB')
-        self.r = data.get('R')
-        self.h = data.get('H')
-        self.rbi = data.get('RBI')
-        self.bb = data.get('BB')
-        self.so = data.get('SO')
-        self.double = data.get('DOUBLE')
-        self.triple = data.get('TRIPLE')
-        self.hr = data.get('HR')
-        self.sf = data.get('SF')
-        self.hbp = data.get('HBP')
-        self.sb = data.get('SB')
-        self.cs = data.get('CS')
-        self.pitches = data.get('PITCHES', 0)
-        self.strikes = data.get('STRIKES', 0)
-        self.balls = data.get('BALLS', 0)
+        """Update from a boxscore entry, return the names of the changed attributes"""
+        position = data.get('POS')
+        if not position and data.get('PITCHIP'):
+            position = 'P'
+        changed = set()
+        for attribute, value in [('lineupcode', lineupcode), ('batting_order', lineupcode[2]), ('position', position)]:
+            if getattr(self, attribute, None) != value:
+                setattr(self, attribute, value)
+                changed.add(attribute)
+        for attribute, key, default in PLAYER_STATS:
+            value = data.get(key, default)
+            if getattr(self, attribute, None) != value:
+                setattr(self, attribute, value)
+                changed.add(attribute)
+        return changed
 
 
 class Team:
+    __slots__ = ('game', 'id', 'code', 'lineup', 'all_players', 'by_lineupcode', 'pitcher',
+                 'primary_color', 'secondary_color', 'image')
+
     def __init__(self, game, id, code, players, logo_url, primary_color, secondary_color):
         self.game = game
         self.id = id
         self.code = code
-        self.lineup = {
-            players[lineupcode]['playerid']: Player(self.game, self, players[lineupcode], lineupcode)
-            for lineupcode in players
-            if players[lineupcode]['teamid'] == id and lineupcode[2] != '0'
-        }
-        self.all_players = {playerid: player for playerid, player in self.lineup.items()}
-        player, lineupcode = [(p, lineupcode)
+        self.all_players = {}
+        # lineupcode: player holding it in the boxscore
+        self.by_lineupcode = {}
+        self.lineup = {}
+        for lineupcode, player in players.items():
+            if player['teamid'] == id and lineupcode[2] != '0':
+                self.lineup[player['playerid']] = self.get_player(player, lineupcode, {})
+        player, lineupcode = next((p, lineupcode)
             for lineupcode, p in players.items()
-            if (p.get('POS') == 'P' or p.get('PITCHIP')) and players[lineupcode]['teamid'] == id][0]
-        self.pitcher = self.get_player(player, lineupcode)
+            if (p.get('POS') == 'P' or p.get('PITCHIP')) and players[lineupcode]['teamid'] == id)
+        self.pitcher = self.get_player(player, lineupcode, {})
         self.primary_color = primary_color
         self.secondary_color = secondary_color
         self.image = False
-        self.all_players[self.pitcher.id] = self.pitcher
         if logo_url:
-            self.image = Image.open(BytesIO(self.game.session.get(logo_url).content))
+            self.image = self.game.get_image(logo_url) or False
+            if not self.image:
+                self.game.photo_loaders.spawn(self.load_image, logo_url)
 
-    def update(self, data):
+    def load_image(self, logo_url):
+        """Logo missed by the prefetch, downloaded again in the background"""
+        self.game.assets.pop(logo_url, None)
+        self.image = self.game.get_image(logo_url) or False
+        if not self.image:
+            self.game.assets.setdefault(logo_url, None)
+
+    def update(self, data, removed=()):
+        """Apply the boxscore entries of the team changed or removed since the previous play, return the changes by player id"""
+        changed = {}
+        for lineupcode in removed:
+            self.leave(lineupcode)
         for lineupcode, player in data.items():
-            if player.get('teamid') != self.id:
-                continue
+            holder = self.by_lineupcode.get(lineupcode)
+            if holder and holder.id != player.get('playerid'):
+                # substitution, the previous player leaves the lineupcode
+                self.leave(lineupcode)
             if lineupcode[2] != '0':
-                if player.get('playerid') in self.lineup:
-                    self.lineup[player['playerid']].update(player, lineupcode)
-                else:
-                    self.lineup[player['playerid']] = self.get_player(player, lineupcode)
-            elif player.get('POS') == 'P' or player.get('PITCHIP'):
-                # TODO: multiple pitchers?
-                if player.get('playerid') == self.pitcher.id:
-                    self.pitcher.update(player, lineupcode)
-                else:
-                    self.pitcher = self.get_player(player, lineupcode)
-
-    def get_player(self, player, lineupcode):
-        if self.all_players.get(player['playerid']):
-            self.all_players[player['playerid']].update(player, lineupcode)
-            return self.all_players[player['playerid']]
+                self.lineup[player['playerid']] = self.get_player(player, lineupcode, changed)
+            else:
+                self.lineup.pop(player.get('playerid'), None)
+                if player.get('POS') == 'P' or player.get('PITCHIP'):
+                    # the pitcher of the fielding team is then set from the situation by the game
+                    self.pitcher = self.get_player(player, lineupcode, changed)
+        return changed
+
+    def leave(self, lineupcode):
+        player = self.by_lineupcode.pop(lineupcode, None)
+        if player and player.lineupcode == lineupcode and self.lineup.get(player.id) is player:
+            del self.lineup[player.id]
+
+    def get_player(self, player, lineupcode, changed):
+        existing = self.all_players.get(player['playerid'])
+        if existing:
+            previous = existing.lineupcode
+            changed[existing.id] = existing.update(player, lineupcode)
+            if previous != lineupcode and self.by_lineupcode.get(previous) is existing:
+                del self.by_lineupcode[previous]
         else:
-            new_player = Player(self.game, self, player, lineupcode)
-            self.all_players[new_player.id] = new_player
-            return new_player
+            existing = Player(self.game, self, player, lineupcode)
+            self.all_players[existing.id] = existing
+            changed[existing.id] = {'lineupcode'}
+        self.by_lineupcode[lineupcode] = existing
+        return existing
 
     def get_lineup(self):
         lineup = sorted([player for x, player in self.lineup.items()], key= lambda p: p.batting_order)
@@ -216,39 +1069,1140 @@ class Team:
         return lineup
 
 
+class LayerDraw:
+    """ImageDraw proxy drawing in the design units of a component at the size of the layer"""
+
+    def __init__(self, image, origin, scale=1, cache=None):
+        self.image = image
+        self.draw = ImageDraw.Draw(image)
+        self.origin = origin
+        self.scale = scale
+        self.cache = {} if cache is None else cache
+
+    def point(self, xy):
+        return ((xy[0] - self.origin[0]) * self.scale, (xy[1] - self.origin[1]) * self.scale)
+
+    def box(self, box):
+        if len(box) == 2:
+            box = tuple(box[0]) + tuple(box[1])
+        return self.point(box[:2]) + self.point(box[2:])
+
+    def size(self, value):
+        return max(1, round(value * self.scale))
+
+    def font(self, size):
+        return get_font(self.size(size))
+
+    def fit_font(self, text, max_width, max_size):
+        return fit_font(text, max_width * self.scale, self.size(max_size))
+
+    def scaled(self, kwargs):
+        for key in ('width', 'radius'):
+            if key in kwargs:
+                kwargs[key] = self.size(kwargs[key])
+        return kwargs
+
+    def polygon(self, points, **kwargs):
+        self.draw.polygon([self.point(point) for point in points], **self.scaled(kwargs))
+
+    def rectangle(self, box, **kwargs):
+        self.draw.rectangle(self.box(box), **self.scaled(kwargs))
+
+    def rounded_rectangle(self, box, **kwargs):
+        self.draw.rounded_rectangle(self.box(box), **self.scaled(kwargs))
+
+    def ellipse(self, box, **kwargs):
+        self.draw.ellipse(self.box(box), **self.scaled(kwargs))
+
+    def pieslice(self, box, **kwargs):
+        self.draw.pieslice(self.box(box), **self.scaled(kwargs))
+
+    def text(self, xy, text, **kwargs):
+        self.draw.text(self.point(xy), text, **kwargs)
+
+    def textlength(self, text, font):
+        return self.draw.textlength(text, font) / self.scale
+
+    def paste(self, image, xy, mask=None, size=None):
+        """Paste image at xy, resized to size (design units) or by scale"""
+        size = (self.size(size[0]), self.size(size[1])) if size else (self.size(image.size[0]), self.size(image.size[1]))
+        if size != image.size:
+            key = (id(image), size)
+            if key not in self.cache:
+                # the source image is kept with its resized version so its id is not reused
+                self.cache[key] = (image, image.resize(size, Image.LANCZOS))
+            scaled = self.cache[key][1]
+            if mask is image:
+                mask = scaled
+            image = scaled
+        point = self.point(xy)
+        self.image.paste(image, (round(point[0]), round(point[1])), mask)
+
+
+class Layer:
+    """Part of an overlay component, only redrawn when its key changes"""
+
+    def __init__(self, box, key, render, scale=1):
+        self.box = box
+        self.key = key
+        self.render = render
+        self.scale = scale
+        self.pixel_box = tuple(round(value * scale) for value in box)
+        self.state = None
+        self.image = None
+        self.cache = {}
+        # state: image, least recently used first
+        self.rendered = {}
+
+    def draw(self, state, background=None):
+        if state in self.rendered:
+            image = self.rendered[state] = self.rendered.pop(state)
+            METRICS.inc('render_cache_hits_total', component=self.render.__name__)
+            return image
+        if background:
+            image = background.crop(self.pixel_box)
+        else:
+            image = Image.new('RGBA', (self.pixel_box[2] - self.pixel_box[0], self.pixel_box[3] - self.pixel_box[1]))
+        with METRICS.time('render_seconds', component=self.render.__name__):
+            self.render(LayerDraw(image, self.box[:2], self.scale, self.cache), state)
+        self.rendered[state] = image
+        while len(self.rendered) > settings.render_cache_size:
+            del self.rendered[next(iter(self.rendered))]
+        return image
+
+    def refresh(self, game, background=None):
+        state = self.key(game)
+        if self.image is not None and state == self.state:
+            return False
+        self.image = self.draw(state, background)
+        self.state = state
+        return True
+
+    def prepare(self, game, background=None):
+        """Render the layer ahead for game, a likely next state"""
+        state = self.key(game)
+        if state != self.state and state not in self.rendered:
+            self.draw(state, background)
+
+    def memory(self):
+        images = dict((id(image), image) for image in self.rendered.values())
+        images[id(self.image)] = self.image
+        return sum(image_bytes(image) for image in images.values()) + sum(image_bytes(scaled) for _, scaled in self.cache.values())
+
+
+class Compositor:
+    """Overlay component of a static background and dynamic layers, only the changed layers are redrawn"""
+
+    def __init__(self, background, layers):
+        self.background = background
+        self.layers = layers
+        self.image = None
+
+    @property
+    def state(self):
+        return tuple(layer.state for layer in [self.background] + self.layers)
+
+    def compose(self, game):
+        if self.background.refresh(game) or self.image is None:
+            self.image = self.background.image.copy()
+            for layer in self.layers:
+                # the renders were drawn on the previous background
+                layer.image = None
+                layer.rendered.clear()
+        dirty = [layer for layer in self.layers if layer.refresh(game, self.background.image)]
+        for layer in dirty:
+            self.image.paste(layer.image, layer.pixel_box[:2])
+        return bool(dirty)
+
+    def prepare(self, game):
+        for layer in self.layers:
+            layer.prepare(game, self.background.image)
+
+    def memory(self):
+        return image_bytes(self.image) + sum(layer.memory() for layer in [self.background] + self.layers)
+
+
+class Speculation:
+    """Stand-in for a game or a player with a few attributes changed, to render a likely next state"""
+
+    def __init__(self, target, **changes):
+        self.target = target
+        self.__dict__.update(changes)
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+
+class PilCanvas:
+    """Overlay composed in a single PIL image with masked pastes"""
+
+    def __init__(self, resolution):
+        self.resolution = resolution
+        self.image = Image.new('RGBA', resolution)
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def clear(self, box=None):
+        self.image.paste((0, 0, 0, 0), box or (0, 0) + self.resolution)
+
+    def paste(self, image, position):
+        try:
+            self.image.paste(image, position, image)
+        except ValueError:
+            self.image.paste(image, position)
+
+    def write(self, writer):
+        writer.write(self.image)
+
+    def memory(self):
+        return image_bytes(self.image)
+
+
+class NumpyCanvas:
+    """Overlay composed in two preallocated RGBA frames, only the changed regions are blended"""
+
+    def __init__(self, resolution):
+        self.resolution = resolution
+        self.frames = [numpy.zeros((resolution[1], resolution[0], 4), numpy.uint8) for _ in range(2)]
+        self.front = 0
+        # regions of the front frame not yet in the back frame
+        self.pending = []
+        self.changed = []
+
+    @property
+    def back(self):
+        return self.frames[1 - self.front]
+
+    @property
+    def image(self):
+        """PIL image sharing the front frame"""
+        return Image.frombuffer('RGBA', self.resolution, self.frames[self.front], 'raw', 'RGBA', 0, 1)
+
+    def region(self, box):
+        left, top = max(box[0], 0), max(box[1], 0)
+        right, bottom = min(box[2], self.resolution[0]), min(box[3], self.resolution[1])
+        return numpy.s_[top:max(top, bottom), left:max(left, right)]
+
+    def begin(self):
+        front = self.frames[self.front]
+        for region in self.pending:
+            self.back[region] = front[region]
+        self.pending = []
+        self.changed = []
+
+    def commit(self):
+        self.front = 1 - self.front
+        self.pending = self.changed
+
+    def clear(self, box=None):
+        region = self.region(box or (0, 0) + self.resolution)
+        self.back[region] = 0
+        self.changed.append(region)
+
+    def paste(self, image, position):
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        region = self.region(position + (position[0] + image.size[0], position[1] + image.size[1]))
+        target = self.back[region]
+        if not target.size:
+            return
+        # crop of the component falling inside the frame
+        top, left = region[0].start - position[1], region[1].start - position[0]
+        source = numpy.asarray(image)[top:top + target.shape[0], left:left + target.shape[1]]
+        if target[..., 3].any():
+            self.blend(target, source)
+        else:
+            # over a transparent region the result is the component itself
+            target[...] = source
+        self.changed.append(region)
+
+    @staticmethod
+    def blend(target, source):
+        """target = source over target, computed in premultiplied alpha with integers"""
+        source = source.astype(numpy.uint32)
+        destination = target.astype(numpy.uint32)
+        # the weights are kept multiplied by 255, rounding them shows on faint pixels
+        source_alpha = source[..., 3:] * 255
+        destination_alpha = destination[..., 3:] * (255 - source[..., 3:])
+        alpha = source_alpha + destination_alpha
+        premultiplied = source[..., :3] * source_alpha + destination[..., :3] * destination_alpha
+        target[..., :3] = (premultiplied + alpha // 2) // numpy.maximum(alpha, 1)
+        target[..., 3:] = (alpha + 127) // 255
+
+    def write(self, writer):
+        writer.write_frame(self.frames[self.front])
+
+    def memory(self):
+        return sum(frame.nbytes for frame in self.frames)
+
+
+class OverlayFileWriter:
+    """Save the overlay as overlay.png, read in loop by the ffmpeg image2 demuxer"""
+
+    def __init__(self, working_dir):
+        self.path = os.path.join(working_dir, 'overlay.png')
+        self.tmp_path = os.path.join(working_dir, 'overlay-tmp.png')
+
+    def ffmpeg_input(self):
+        return ['-f', 'image2', '-framerate', str(OVERLAY_FRAMERATE), '-loop', '1', '-i', self.path], ()
+
+    def write(self, image):
+        image.save(self.tmp_path, "PNG")
+        os.replace(self.tmp_path, self.path)
+
+    def write_frame(self, frame):
+        self.write(Image.frombuffer('RGBA', (frame.shape[1], frame.shape[0]), frame, 'raw', 'RGBA', 0, 1))
+
+    def write_file(self, path):
+        shutil.copyfile(path, self.tmp_path)
+        os.replace(self.tmp_path, self.path)
+
+    def run(self, game):
+        pass
+
+
+class OverlayPipe:
+    """Pipe to one ffmpeg, written by its own greenlet with the latest frame"""
+
+    def __init__(self, write_fd):
+        self.file = FileObjectPosix(write_fd, 'wb', bufsize=0)
+        self.frame = None
+        self.ready = gevent.event.Event()
+        self.greenlet = gevent.spawn(self.run)
+
+    def send(self, frame):
+        if self.frame is not None:
+            # ffmpeg is not reading, its frame is dropped rather than holding the other pipes
+            METRICS.inc('overlay_frames_dropped_total')
+        self.frame = frame
+        self.ready.set()
+
+    def run(self):
+        while True:
+            self.ready.wait()
+            self.ready.clear()
+            frame, self.frame = self.frame, None
+            written = 0
+            try:
+                while written < len(frame):
+                    written += self.file.write(frame[written:])
+            except OSError:
+                logger.info('Overlay pipe closed by ffmpeg')
+                self.file.close()
+                return
+
+    @property
+    def closed(self):
+        return self.greenlet.dead
+
+    def close(self):
+        self.greenlet.kill(block=False)
+        self.file.close()
+
+
+class OverlayPipeWriter:
+    """Push the overlay as raw RGBA frames to every ffmpeg through its own pipe at OVERLAY_FRAMERATE"""
+
+    def __init__(self, resolution):
+        self.resolution = resolution
+        self.frame = memoryview(bytes(resolution[0] * resolution[1] * 4))
+        self.pipes = []
+
+    def ffmpeg_input(self):
+        read_fd, write_fd = os.pipe()
+        self.pipes.append(OverlayPipe(write_fd))
+        return [
+            '-f', 'rawvideo',
+            '-pix_fmt', 'rgba',
+            '-video_size', '%sx%s' % self.resolution,
+            '-framerate', str(OVERLAY_FRAMERATE),
+            '-i', 'pipe:%s' % read_fd,
+        ], (read_fd,)
+
+    def write(self, image):
+        self.frame = memoryview(image.tobytes())
+
+    def write_frame(self, frame):
+        # the pipes may still be writing this frame when the canvas composes the next overlay in it
+        self.frame = memoryview(frame).cast('B').tobytes()
+
+    def write_file(self, path):
+        with Image.open(path) as image:
+            self.write(image.convert('RGBA'))
+
+    def push(self):
+        for pipe in list(self.pipes):
+            if pipe.closed:
+                self.pipes.remove(pipe)
+            else:
+                pipe.send(self.frame)
+
+    def run(self, game):
+        # frames are scheduled on absolute times so the rawvideo timestamps follow the wall clock
+        start = time.monotonic()
+        frame = 0
+        while not game.force_end:
+            self.push()
+            frame += 1
+            gevent.sleep(max(0, start + frame / OVERLAY_FRAMERATE - time.monotonic()))
+
+    def close(self):
+        for pipe in self.pipes:
+            pipe.close()
+        self.pipes = []
+
+
+class OverlayFrameStore:
+    """Save the overlays of a pre-rendered replay, one PNG per play showing a new overlay"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.play = None
+        self.path = None
+
+    def write(self, image):
+        self.path = os.path.join(self.directory, '%s.png' % self.play)
+        image.save(self.path, 'PNG', compress_level=1)
+
+    def write_frame(self, frame):
+        self.write(Image.frombuffer('RGBA', (frame.shape[1], frame.shape[0]), frame, 'raw', 'RGBA', 0, 1))
+
+
+def prerender_plays(worker_settings, stats, headshots, game_info, replay_mode, resolution, plays, directory):
+    """Render the overlays of plays in a worker process, return the frame file of every play"""
+    # the workers replay the same plays in memory, only the service writes stats_db
+    worker_settings.stats_db = ':memory:'
+    configure(worker_settings)
+    STATS.seed(stats)
+    PHOTOS.workers = 0
+    game = Game(game_info, mode='replay', replay_mode=replay_mode, resolution=resolution, stream=False, headshots=headshots)
+    writer = game.overlay_writer = OverlayFrameStore(directory)
+    writer.play = plays[0]
+    game.photo_loaders.join()
+    frames = {}
+    try:
+        # plays before the chunk are only applied to get the state of the game
+        for play in game.archive.plays[bisect.bisect_left(game.archive.plays, game.current_play):]:
+            if play > plays[-1]:
+                break
+            game.update_game(game.archive.read(play))
+            if play >= plays[0]:
+                game.current_play = writer.play = play
+                game.make_overlay()
+                frames[play] = writer.path
+    finally:
+        game.replay.stop()
+        game.archive.close()
+    return frames
+
+
+def udp_output(port):
+    """tee muxer output sending MPEG-TS to a local udp port"""
+    return '[f=mpegts:onfail=ignore]udp://127.0.0.1:%s?pkt_size=1316' % port
+
+
+def encode_options(cpus=None):
+    """Encoding of every segment of the broadcast, identical so the relays can switch between them"""
+    return [
+        '-c:a', 'aac',
+        '-b:a', '96k',
+        '-ar', '48000',
+        '-ac', '2',
+        '-strict', 'experimental',
+        '-b:v', '3000k',
+        '-vcodec', 'h264',
+        '-preset', 'ultrafast',
+        '-pix_fmt', 'yuv420p',
+        '-r', str(STREAM_FRAMERATE),
+        '-g', str(STREAM_KEYINT),
+        '-keyint_min', str(STREAM_KEYINT),
+        '-sc_threshold', '0',
+        '-s', '1920x1080',
+    ] + (['-threads', str(len(cpus))] if cpus else [])
+
+
+class Supervisor:
+    """Keep an ffmpeg process running for the whole game, restarted with backoff when it exits or stalls"""
+
+    def __init__(self, name, spawn, progress_key='frame', on_exit=None):
+        self.name = name
+        self.spawn = spawn
+        self.progress_key = progress_key
+        self.on_exit = on_exit
+        self.proc = None
+        self.greenlet = None
+        self.stopped = False
+        self.failures = 0
+        self.progress = None
+        self.progress_time = None
+
+    @property
+    def healthy(self):
+        """Running and reporting progress"""
+        return (self.proc is not None and self.proc.poll() is None and self.progress is not None
+                and time.monotonic() - self.progress_time < settings.stall_timeout)
+
+    def start(self):
+        self.stopped = False
+        self.greenlet = gevent.spawn(self.run)
+
+    def run(self):
+        while not self.stopped:
+            started = time.monotonic()
+            self.progress = None
+            self.progress_time = started
+            try:
+                self.proc = self.spawn()
+            except OSError:
+                logger.exception('Could not start FFmpeg %s', self.name)
+                retcode = None
+            else:
+                watchers = [gevent.spawn(self.read_progress, self.proc), gevent.spawn(self.watch_stall, self.proc)]
+                try:
+                    retcode = self.proc.wait()
+                finally:
+                    # also when stopped, a stopped process is not reported as stalled
+                    gevent.killall(watchers, block=False)
+            if self.stopped:
+                break
+            if self.on_exit:
+                self.on_exit(self)
+            if time.monotonic() - started > RESTART_BACKOFF_RESET:
+                self.failures = 0
+            delay = min(settings.restart_backoff * 2 ** self.failures, settings.restart_backoff_max)
+            self.failures += 1
+            logger.info('FFmpeg %s stopped (return code %s), restarting in %.1fs', self.name, retcode, delay)
+            METRICS.inc('stream_restarts_total', process=self.name)
+            gevent.sleep(delay)
+
+    def read_progress(self, proc):
+        """Publish the -progress reports, one block of key=value lines per report"""
+        progress = {}
+        for line in proc.stdout:
+            key, _, value = line.strip().partition('=')
+            if key != 'progress':
+                progress[key] = value
+                continue
+            for key, name in FFMPEG_PROGRESS:
+                try:
+                    METRICS.set(name, float(progress.get(key, '').rstrip('kbits/x')), process=self.name)
+                except ValueError:
+                    pass
+            if progress.get(self.progress_key) not in (None, 'N/A', self.progress):
+                self.progress = progress[self.progress_key]
+                self.progress_time = time.monotonic()
+                if self.progress_key == 'frame':
+                    METRICS.startup('first_frame')
+            progress = {}
+
+    def watch_stall(self, proc):
+        while True:
+            remaining = self.progress_time + settings.stall_timeout - time.monotonic()
+            if remaining <= 0:
+                break
+            gevent.sleep(remaining)
+        logger.info('FFmpeg %s stalled for %ss, killing it', self.name, settings.stall_timeout)
+        METRICS.inc('stream_stalls_total', process=self.name)
+        proc.kill()
+
+    def stop(self):
+        self.stopped = True
+        if self.proc and self.proc.poll() is None:
+            self.proc.kill()
+            logger.info("FFmpeg %s terminated.", self.name)
+        if self.greenlet:
+            self.greenlet.kill(block=False)
+
+
+class StreamOutput:
+    """RTMP endpoint fed by the tee muxer of the encoder through a local udp port"""
+
+    def __init__(self, name, url, port, logfile=None):
+        self.name = name
+        self.url = url
+        self.port = port
+        self.logfile = logfile
+        # a copy has no frame counter, a relay makes progress as long as it writes
+        self.supervisor = Supervisor(name, self.spawn, progress_key='total_size')
+
+    def spawn(self):
+        command = [
+            'ffmpeg',
+            '-progress', 'pipe:1',
+            # timestamps of the relay do not depend on the encoder, the RTMP session survives encoder restarts
+            '-use_wallclock_as_timestamps', '1',
+            '-fflags', '+genpts+discardcorrupt',
+            '-f', 'mpegts',
+            '-i', 'udp://127.0.0.1:%s?fifo_size=1000000&overrun_nonfatal=1' % self.port,
+            '-c', 'copy',
+            '-bsf:a', 'aac_adtstoasc',
+            '-f', 'flv',
+            self.url,
+        ]
+        logger.info('FFMPEG %s relay command: %s', self.name, ' '.join(command))
+        return subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=self.logfile or subprocess.STDOUT, universal_newlines=True)
+
+    def start(self):
+        self.supervisor.start()
+
+    def stop(self):
+        self.supervisor.stop()
+
+
+class TsScanner:
+    """PAT, PMT and video keyframes of the MPEG-TS sent by a source"""
+    PACKET_SIZE = 188
+    # H.262, H.264 and H.265 stream types of the PMT
+    VIDEO_TYPES = (0x02, 0x1b, 0x24)
+
+    def __init__(self):
+        self.pat = None
+        self.pmt_pid = None
+        self.pmt = None
+        self.video_pid = None
+
+    @staticmethod
+    def section(packet):
+        """PSI section starting in packet, None if it continues a previous one"""
+        if not packet[1] & 0x40:
+            return None
+        start = 4
+        if packet[3] & 0x20:
+            start += 1 + packet[4]
+        start += 1 + packet[start]
+        length = ((packet[start + 1] & 0x0f) << 8) | packet[start + 2]
+        return packet[start:start + 3 + length]
+
+    def table(self, packet, pid):
+        if pid == 0:
+            section = self.section(packet)
+            if section:
+                # first program of the table, program 0 is the network information
+                for index in range(8, len(section) - 4, 4):
+                    if section[index:index + 2] != b'\0\0':
+                        self.pat = packet
+                        self.pmt_pid = ((section[index + 2] & 0x1f) << 8) | section[index + 3]
+                        break
+        elif pid == self.pmt_pid:
+            section = self.section(packet)
+            if section:
+                self.pmt = packet
+                index = 12 + (((section[10] & 0x0f) << 8) | section[11])
+                while index + 5 <= len(section) - 4:
+                    if section[index] in self.VIDEO_TYPES:
+                        self.video_pid = ((section[index + 1] & 0x1f) << 8) | section[index + 2]
+                        break
+                    index += 5 + (((section[index + 3] & 0x0f) << 8) | section[index + 4])
+
+    def keyframe(self, datagram):
+        """Offset of the first video packet of a keyframe in datagram once the PAT and PMT are known, else None"""
+        for offset in range(0, len(datagram) - self.PACKET_SIZE + 1, self.PACKET_SIZE):
+            packet = datagram[offset:offset + self.PACKET_SIZE]
+            if packet[0] != 0x47:
+                return None
+            pid = ((packet[1] & 0x1f) << 8) | packet[2]
+            if pid == self.video_pid and self.pmt and packet[1] & 0x40 and packet[3] & 0x20 and packet[4] \
+                    and packet[5] & 0x40:
+                return offset
+            self.table(packet, pid)
+        return None
+
+
+class StreamSwitch:
+    """Forward the stream of the active source to the relays, switching at a keyframe"""
+
+    def __init__(self, ports, targets):
+        self.ports = ports
+        self.targets = [('127.0.0.1', port) for port in targets]
+        self.active = None
+        # source forwarded once it sends a keyframe
+        self.target = None
+        self.scanner = None
+        self.sockets = []
+        self.greenlets = []
+
+    def select(self, name):
+        self.target = name
+        self.scanner = TsScanner()
+        if name is None:
+            self.active = None
+
+    def start(self):
+        for name, port in self.ports.items():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            sock.bind(('127.0.0.1', port))
+            self.sockets.append(sock)
+            self.greenlets.append(gevent.spawn(self.forward, sock, name))
+
+    def receive(self, name, datagram):
+        """Part of a datagram of source name forwarded to the relays, None if it is dropped"""
+        if name == self.target and name != self.active:
+            offset = self.scanner.keyframe(datagram)
+            if offset is None:
+                return None
+            self.active = name
+            return self.scanner.pat + self.scanner.pmt + datagram[offset:]
+        if name != self.active:
+            return None
+        return datagram
+
+    def forward(self, sock, name):
+        while True:
+            packet = self.receive(name, sock.recv(65536))
+            if packet is None:
+                continue
+            for target in self.targets:
+                try:
+                    sock.sendto(packet, target)
+                except OSError:
+                    pass
+
+    def stop(self):
+        gevent.killall(self.greenlets, block=False)
+        for sock in self.sockets:
+            sock.close()
+        self.greenlets = []
+        self.sockets = []
+
+
+class Playout:
+    """Every segment of the broadcast through one persistent set of RTMP relays"""
+
+    def __init__(self, field, logfile=None):
+        self.logfile = logfile
+        self.outputs = [StreamOutput('main', field.main_stream, field.relay_port, logfile)]
+        if field.backup_stream:
+            self.outputs.append(StreamOutput('backup', field.backup_stream, field.relay_port + 1, logfile))
+        ports = ('encoder', 'standby', 'slate', 'video')
+        self.switch = StreamSwitch({name: field.standby_port + index for index, name in enumerate(ports)},
+                                   [output.port for output in self.outputs])
+        self.slate = Supervisor('slate', self.spawn_slate, progress_key='total_size')
+        self.encoders = []
+        self.segment = None
+        self.video = None
+        self.greenlet = None
+
+    def start(self):
+        for output in self.outputs:
+            output.start()
+        self.switch.start()
+        self.greenlet = gevent.spawn(self.watch)
+
+    def segment_command(self, options, name):
+        command = ['ffmpeg'] + options + encode_options() + ['-f', 'mpegts', 'udp://127.0.0.1:%s?pkt_size=1316' % self.switch.ports[name]]
+        logger.info('FFMPEG %s command: %s', name, ' '.join(command))
+        return command
+
+    def spawn_slate(self):
+        if settings.standby_file:
+            video = ['-re', '-loop', '1', '-framerate', str(STREAM_FRAMERATE), '-i', settings.standby_file]
+        else:
+            video = ['-re', '-f', 'lavfi', '-i', 'color=c=black:s=1920x1080:r=%s' % STREAM_FRAMERATE]
+        command = self.segment_command(['-progress', 'pipe:1'] + video + [
+            '-f', 'lavfi', '-i', 'anullsrc=r=48000:cl=stereo', '-map', '0:v', '-map', '1:a'], 'slate')
+        return subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=self.logfile or subprocess.STDOUT, universal_newlines=True)
+
+    def play(self, file):
+        """Stream a video file, return once it is over"""
+        self.segment = 'video'
+        self.update()
+        command = self.segment_command(['-re', '-i', file, '-map', '0:v', '-map', '0:a?'], 'video')
+        self.video = subprocess.Popen(command, stdin=subprocess.DEVNULL, stderr=self.logfile or subprocess.STDOUT)
+        self.video.wait()
+        self.video = None
+
+    def go_live(self, encoders):
+        self.encoders = encoders
+        self.segment = 'live'
+        self.update()
+
+    def update(self, *args):
+        """Forward the current segment, on the live segment the first healthy encoder or the slate"""
+        if self.segment != 'live':
+            source = self.segment
+        else:
+            healthy = [encoder.name for encoder in self.encoders if encoder.healthy]
+            source = self.switch.target if self.switch.target in healthy else next(iter(healthy), 'slate')
+        running = self.slate.greenlet is not None and not self.slate.stopped
+        if source == 'slate' and not running:
+            self.slate.start()
+        elif source != 'slate' and running:
+            self.slate.stop()
+        if source != self.switch.target:
+            logger.info('Playout switching from %s to %s', self.switch.target, source)
+            if self.switch.target in ('encoder', 'standby') and source in ('encoder', 'standby'):
+                METRICS.inc('stream_failovers_total')
+            METRICS.inc('playout_switches_total', source=source)
+            self.switch.select(source)
+
+    def watch(self):
+        while True:
+            gevent.sleep(1)
+            self.update()
+
+    def stop(self):
+        if self.greenlet:
+            self.greenlet.kill(block=False)
+        if self.video and self.video.poll() is None:
+            self.video.kill()
+        self.slate.stop()
+        for output in self.outputs:
+            output.stop()
+        self.switch.stop()
+
+
+class GameArchive:
+    """All the plays of a game in a single local file, followed by their index"""
+    MAGIC = b'WBSCARC1'
+    FOOTER = struct.Struct('<QI')
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        if self.file.read(len(self.MAGIC)) != self.MAGIC:
+            raise ValueError('%s is not a game archive' % path)
+        self.file.seek(-self.FOOTER.size, os.SEEK_END)
+        offset, length = self.FOOTER.unpack(self.file.read(self.FOOTER.size))
+        self.file.seek(offset)
+        index = json.loads(zlib.decompress(self.file.read(length)))
+        self.game_id = index['game_id']
+        self.plays = [entry[0] for entry in index['plays']]
+        self.index = {entry[0]: entry[1:] for entry in index['plays']}
+        self.times = [entry[3] for entry in index['plays']]
+        self.missing = index.get('missing', [])
+
+    @classmethod
+    def path_for(cls, game_id, directory=None):
+        return os.path.join(directory or settings.archive_dir, '%s.wbsc' % game_id)
+
+    @classmethod
+    def open(cls, session, game_id, path):
+        """Archive of the game at path, downloaded first if it is missing or incomplete"""
+        previous = cls(path) if os.path.exists(path) else None
+        if previous and not previous.missing:
+            return previous
+        try:
+            return cls.download(session, game_id, path, previous=previous)
+        except (requests.RequestException, ValueError):
+            if not previous:
+                raise
+            logger.exception('Could not complete the archive of game %s, %s plays missing', game_id, len(previous.missing))
+            return cls(path)
+        finally:
+            if previous:
+                previous.close()
+
+    @classmethod
+    def download(cls, session, game_id, path, concurrency=None, previous=None):
+        """Download every play of the game, the plays already in the archive previous are kept"""
+        last_play = int(session.get(LATEST_PLAY_URL % (settings.wbsc_url, game_id), headers=HEADERS, timeout=TIMEOUT).json())
+
+        def fetch(play):
+            for attempt in range(3):
+                try:
+                    response = session.get(PLAY_URL % (settings.wbsc_url, game_id, play), headers=HEADERS, timeout=TIMEOUT)
+                    response.raise_for_status()
+                    return play, response.json()
+                except requests.RequestException:
+                    gevent.sleep(attempt + 1)
+                except ValueError:
+                    break
+            logger.info('Could not download play %s of game %s', play, game_id)
+            return play, None
+
+        plays = {play: previous.read(play) for play in previous.plays} if previous else {}
+        missing = []
+        pool = gevent.pool.Pool(concurrency or settings.asset_concurrency)
+        for play, data in pool.imap_unordered(fetch, [play for play in range(1, last_play + 1) if play not in plays]):
+            if data is not None:
+                plays[play] = data
+            else:
+                missing.append(play)
+        cls.write(path, game_id, plays, missing)
+        if missing:
+            logger.warning('Archived %s plays of game %s in %s, %s plays missing are downloaded again on next use',
+                           len(plays), game_id, path, len(missing))
+        else:
+            logger.info('Archived %s plays of game %s in %s', len(plays), game_id, path)
+        return cls(path)
+
+    @classmethod
+    def write(cls, path, game_id, plays, missing=()):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        index = []
+        with open(path + '.tmp', 'wb') as f:
+            f.write(cls.MAGIC)
+            for play in sorted(plays):
+                data = plays[play]
+                blob = zlib.compress(json.dumps(data, separators=(',', ':')).encode(), 9)
+                index.append([play, f.tell(), len(blob),
+                              int(data.get('playdata')[0].get('t')),
+                              data.get('situation', {}).get('currentinning')])
+                f.write(blob)
+            blob = zlib.compress(json.dumps({'game_id': game_id, 'plays': index, 'missing': sorted(missing)}).encode(), 9)
+            offset = f.tell()
+            f.write(blob)
+            f.write(cls.FOOTER.pack(offset, len(blob)))
+        os.replace(path + '.tmp', path)
+
+    def read(self, play):
+        offset, length = self.index[play][:2]
+        self.file.seek(offset)
+        return json.loads(zlib.decompress(self.file.read(length)))
+
+    def find_time(self, t):
+        """First play at or after the playdata timestamp t"""
+        position = bisect.bisect_left(self.times, t)
+        return self.plays[min(position, len(self.plays) - 1)]
+
+    def find_inning(self, inning):
+        """First play of an inning given as 5, TOP 5 or BOT 5"""
+        inning = inning.upper().strip()
+        for play in self.plays:
+            current = self.index[play][3] or ''
+            if current == inning or current.split()[-1:] == [inning]:
+                return play
+        raise KeyError(inning)
+
+    def seek(self, position):
+        """Play number from a play:<number> or inning:<inning> position"""
+        kind, _, value = position.partition(':')
+        if kind == 'inning':
+            return self.find_inning(value)
+        play = int(value)
+        return self.plays[min(bisect.bisect_left(self.plays, play), len(self.plays) - 1)]
+
+    def close(self):
+        self.file.close()
+
+
+class ReplayReader:
+    """Read ahead the plays of an archive in a greenlet"""
+
+    def __init__(self, archive, start, size=50):
+        self.archive = archive
+        self.queue = gevent.queue.Queue(size)
+        self.greenlet = gevent.spawn(self.produce, start)
+
+    def produce(self, start):
+        for play in self.archive.plays[bisect.bisect_left(self.archive.plays, start):]:
+            self.queue.put((play, self.archive.read(play)))
+        self.queue.put((None, None))
+
+    def next(self):
+        """Next (play number, play data), (None, None) at the end of the archive"""
+        return self.queue.get()
+
+    def stop(self):
+        self.greenlet.kill(block=False)
+
+
+class LiveIngest:
+    """Poll latest.json of a live game adaptively and fetch every new play"""
+
+    def __init__(self, session, game_id, concurrency=None):
+        self.session = session
+        self.game_id = game_id
+        self.concurrency = concurrency or settings.asset_concurrency
+        self.headers = {}
+        self.latest = None
+        self.interval = settings.poll_min_interval
+        self.play_gap = None
+        self.last_play_time = None
+
+    def get_latest(self):
+        with METRICS.time('wbsc_request_seconds', request='latest'):
+            response = self.session.get(LATEST_PLAY_URL % (settings.wbsc_url, self.game_id), headers=dict(HEADERS, **self.headers), timeout=settings.poll_timeout)
+        if response.status_code == 304:
+            return self.latest
+        response.raise_for_status()
+        self.headers = {}
+        if response.headers.get('ETag'):
+            self.headers['If-None-Match'] = response.headers['ETag']
+        if response.headers.get('Last-Modified'):
+            self.headers['If-Modified-Since'] = response.headers['Last-Modified']
+        self.latest = int(response.json())
+        return self.latest
+
+    def get_play(self, play):
+        with METRICS.time('wbsc_request_seconds', request='play'):
+            response = self.session.get(PLAY_URL % (settings.wbsc_url, self.game_id, play), headers=HEADERS, timeout=settings.poll_timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def poll(self, current_play):
+        """New plays after current_play as (play, data) in order"""
+        try:
+            latest = self.get_latest()
+        except (requests.RequestException, ValueError) as e:
+            logger.info('Could not get latest play: %s', e)
+            METRICS.inc('wbsc_errors_total', request='latest')
+            self.slow_down()
+            return []
+        if latest is None or latest <= current_play:
+            self.slow_down()
+            return []
+
+        def fetch(play):
+            try:
+                return play, self.get_play(play)
+            except (requests.RequestException, ValueError) as e:
+                logger.info('Could not get play %s: %s', play, e)
+                METRICS.inc('wbsc_errors_total', request='play')
+                return play, None
+
+        fetched = gevent.pool.Pool(self.concurrency).map(fetch, range(current_play + 1, latest + 1))
+        # the plays after a failed one wait for the next poll, current_play must not skip it
+        plays = []
+        for play, data in fetched:
+            if data is None:
+                break
+            plays.append((play, data))
+        if plays:
+            self.speed_up()
+        return plays
+
+    def speed_up(self):
+        now = time.monotonic()
+        if self.last_play_time:
+            gap = now - self.last_play_time
+            self.play_gap = gap if self.play_gap is None else 0.8 * self.play_gap + 0.2 * gap
+        self.last_play_time = now
+        self.interval = settings.poll_min_interval
+
+    def slow_down(self):
+        max_interval = settings.poll_max_interval
+        if self.play_gap:
+            max_interval = min(max_interval, max(settings.poll_min_interval, self.play_gap / 4))
+        self.interval = min(self.interval * 1.5, max_interval)
+
+
 class Game:
-    def __init__(self, game_info, mode='live', replay_mode='realtime', resolution=INPUT_RESOLUTION):
+    def __init__(self, game_info, mode='live', replay_mode='realtime', resolution=INPUT_RESOLUTION, stream=True,
+                 session=None, cpus=None, discovery=None, headshots=None):
         gameid = game_info.get('live_score_id')
         self.id = gameid
+        # the season stats are shared by the games of an event
+        self.event_id = game_info.get('event_id') or gameid
+        self.field = get_field(game_info)
+        # camera shown, can be switched during the game with the hot camera switch
+        self.camera = game_info.get('camera')
+        # CPUs the encoders are pinned on, split between the encoder and the standby
+        self.cpus = cpus
         self.resolution = resolution
         self.mode = mode
         self.replay_mode = replay_mode
-        self.stream_proc = None
+        self.encoders = []
+        self.playout = None
         self.game_started = False
         self.force_end = False
         self.game_info = game_info
-        self.logfile = open(LOGFILE, 'a') if LOGFILE else None
-        self.initialize_stream()
+        # everything held by the game, released at once by release()
+        self.arena = contextlib.ExitStack()
+        self.arena.callback(self.forget)
+        self.assets = {}
+        self.photo_loaders = gevent.pool.Group()
+        self.arena.callback(self.photo_loaders.kill)
+        # photo url: headshot file already processed, neither downloaded nor processed again
+        self.headshots = headshots or {}
+        self.boxscore = {}
+        self.changed_players = {}
+        self.batter_labels = {}
+        if session is None:
+            session = make_session()
+            self.arena.callback(session.close)
+        self.session = session
+        self.discovery = discovery
+        self.archive = None
+        self.replay = None
+        self.prerendered = {}
+        if self.mode == 'replay':
+            self.open_archive()
+        self.logfile = self.arena.enter_context(open(settings.logfile, 'a')) if settings.logfile and stream else None
+        if settings.overlay_output == 'pipe':
+            self.overlay_writer = OverlayPipeWriter(self.resolution)
+        else:
+            os.makedirs(self.field.working_dir, exist_ok=True)
+            self.overlay_writer = OverlayFileWriter(self.field.working_dir)
+        self.init_overlay()
+        self.overlay_pusher = None
+        if stream:
+            # the overlay frames flow before the encoders start, their overlay input never stalls
+            self.overlay_pusher = gevent.spawn(self.overlay_writer.run, self)
+            self.arena.callback(self.overlay_pusher.kill)
+            self.initialize_stream()
         self.init_game()
+        if self.mode == 'replay' and settings.replay_prerender and stream:
+            # rendered while the intro is playing
+            gevent.spawn(self.prerender)
+
+    def open_archive(self):
+        # downloaded before the stream starts, the replay does not use the network
+        self.archive = GameArchive.open(self.session, self.id, GameArchive.path_for(self.id))
+
+    def replay_start(self):
+        return self.archive.seek(settings.replay_start) if settings.replay_start else self.archive.plays[0]
+
+    def prerender(self):
+        directory = os.path.join(self.field.working_dir, 'prerender', str(self.id))
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        self.arena.callback(shutil.rmtree, directory, ignore_errors=True)
+        plays = self.archive.plays[bisect.bisect_left(self.archive.plays, self.replay_start()):]
+        size = -(-len(plays) // settings.prerender_workers)
+        start = time.time()
+        pool = ProcessPoolExecutor(settings.prerender_workers, mp_context=multiprocessing.get_context('spawn'))
+        stats = STATS.export(self.event_id)
+        # the workers reuse the headshots of the players of the first play instead of finding their faces again
+        self.photo_loaders.join()
+        urls = set(player.image_url for team in (self.home, self.away) if team for player in team.all_players.values())
+        headshots = {url: PHOTOS.paths[url] for url in urls if url in PHOTOS.paths}
+        try:
+            futures = [pool.submit(prerender_plays, settings, stats, headshots, self.game_info, self.replay_mode, self.resolution, plays[i:i + size], directory)
+                       for i in range(0, len(plays), size)]
+            for future in futures:
+                self.prerendered.update(future.result())
+            logger.info('Pre-rendered %s plays in %.1fs', len(self.prerendered), time.time() - start)
+        except Exception:
+            logger.exception('Could not pre-render the replay, rendering each play when shown')
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def show_play(self, play):
+        frame = self.prerendered.get(play)
+        if frame:
+            self.overlay_writer.write_file(frame)
+            # the next overlay rendered here has to be written in full
+            self.overlay_state = None
+        else:
+            self.make_overlay()
 
     def init_game(self):
         try:
-            self.session = requests.Session()
             if self.mode == 'live':
-                last_play = self.session.get(LATEST_PLAY_URL % self.id, headers=HEADERS)
-                last_play = int(last_play.json())
-                self.current_play = last_play
-                data = self.session.get(PLAY_URL % (self.id, last_play), headers=HEADERS)
-                data = data.json()
+                self.ingest = LiveIngest(self.session, self.id)
+                self.current_play = self.ingest.get_latest()
+                data = self.ingest.get_play(self.current_play)
             else:
-                self.current_play = 1
-                data = self.session.get(PLAY_URL % (self.id, self.current_play), headers=HEADERS)
-                data = data.json()
+                self.current_play = self.replay_start()
+                data = self.archive.read(self.current_play)
+                self.replay = ReplayReader(self.archive, self.current_play)
             self.beginning = int(data.get('playdata')[0].get('t'))
             self.data = data
             home_id = data.get('eventhomeid')
             away_id = data.get('eventawayid')
             players = data.get('boxscore')
+            self.boxscore = {}
+            self.prefetch_assets(
+                [player.get('image') for player in players.values()] +
+                [self.game_info.get('home_logo'), self.game_info.get('away_logo')])
             self.home = Team(self, home_id, data.get('eventhome'), players, self.game_info.get('home_logo'), hex2rgb(self.game_info.get('home_primary_color')), hex2rgb(self.game_info.get('home_secondary_color')))
             self.away = Team(self, away_id, data.get('eventaway'), players, self.game_info.get('away_logo'), hex2rgb(self.game_info.get('away_primary_color')), hex2rgb(self.game_info.get('away_secondary_color')))
             self.update_game(data)
@@ -256,13 +2210,65 @@ class Game:
         except Exception:
             logger.exception('Could not initialize game from wbsc')
 
+    def prefetch_assets(self, urls):
+        """Download photos and logos concurrently into self.assets, None for the ones missed by settings.asset_deadline"""
+        urls = set(url for url in urls
+                   if url and url != DEFAULT_IMAGE_URL and url not in self.assets and url not in self.headshots)
+
+        def fetch(url):
+            try:
+                self.assets[url] = ASSETS.get(self.session, url)
+            except requests.RequestException as e:
+                logger.info('Could not download %s: %s', url, e)
+
+        pool = gevent.pool.Pool(settings.asset_concurrency)
+        with gevent.Timeout(settings.asset_deadline, False):
+            pool.map(fetch, urls)
+        pool.kill(block=False)
+        missing = [url for url in urls if url not in self.assets]
+        for url in missing:
+            self.assets[url] = None
+        logger.info('Prefetched %s assets, %s missing', len(urls) - len(missing), len(missing))
+
+    def get_image(self, url):
+        """Decoded image of url shared through the image pool, None when the prefetch gave up on it"""
+        if url in self.assets and self.assets[url] is None:
+            return None
+        try:
+            content = self.assets.pop(url, None)
+            if content is None:
+                content = ASSETS.get(self.session, url)
+            return IMAGES.get((url, hashlib.sha1(content).hexdigest()), functools.partial(load_image, BytesIO(content)))
+        except Exception:
+            logger.exception('Could not load image %s', url)
+            return None
+
     def update_game(self, data):
         self.data = data
         pitcherid = data.get('situation')['pitcherid']
         batterid = data.get('situation')['batterid']
 
-        self.home.update(data.get('boxscore'))
-        self.away.update(data.get('boxscore'))
+        # only the boxscore entries which changed since the previous play are applied
+        boxscore = data.get('boxscore')
+        entries = {self.home.id: {}, self.away.id: {}}
+        removed = {self.home.id: [], self.away.id: []}
+        for lineupcode, entry in boxscore.items():
+            if entry.get('teamid') in entries and self.boxscore.get(lineupcode) != entry:
+                entries[entry['teamid']][lineupcode] = entry
+        for lineupcode, entry in self.boxscore.items():
+            if lineupcode not in boxscore and entry.get('teamid') in removed:
+                removed[entry['teamid']].append(lineupcode)
+        self.boxscore = boxscore
+        STATS.update(self.event_id, self.id, [entry for team in entries.values() for entry in team.values()])
+        self.changed_players = self.home.update(entries[self.home.id], removed[self.home.id])
+        self.changed_players.update(self.away.update(entries[self.away.id], removed[self.away.id]))
+        for team in (self.home, self.away):
+            if pitcherid in team.all_players:
+                team.pitcher = team.all_players[pitcherid]
+        # the label of a player only follows its own stats
+        for playerid, changed in self.changed_players.items():
+            if changed:
+                self.batter_labels.pop(playerid, None)
 
         self.batter = self.home.lineup.get(batterid) or self.away.lineup.get(batterid)
         self.pitcher = self.home.pitcher if self.home.pitcher.id == pitcherid else self.away.pitcher
@@ -280,55 +2286,110 @@ class Game:
         self.balls = data.get('situation').get('balls')
         self.strikes = data.get('situation').get('strikes')
 
-    def get_current_batter(self):
-        self.batter.team.primary_color
-        main_color = self.batter.team.primary_color
+    def batter_label(self, batter):
+        if settings.test_time:
+            return str(datetime.now())
+        if batter.pa:
+            player_label = 'This game: %s for %s' % (batter.h, batter.ab)
+            if batter.hr:
+                player_label += ', %s %s' % (batter.hr, 'HR')
+            elif batter.triple:
+                player_label += ', %s %s' % (batter.triple, 'triple')
+            elif batter.double:
+                player_label += ', %s %s' % (batter.double, 'double')
+            if batter.bb:
+                player_label += ', %s %s' % (batter.bb, 'BB')
+        else:
+            line = STATS.line(self.event_id, self.id, batter.id)
+            average = '%.3f' % line['avg']
+            if average.startswith('0'):
+                average = average[1:]
+            player_label = 'This season: %s avg' % average
+            for stat, label in [('h', 'H'), ('double', '2B'), ('triple', '3B'), ('hr', 'HR'), ('bb', 'BB')]:
+                if line[stat]:
+                    player_label += ', %s %s' % (line[stat], label)
+        return player_label
+
+    def batter_state(self):
+        batter = self.batter
+        if batter.id not in self.batter_labels:
+            self.batter_labels[batter.id] = self.batter_label(batter)
+        label = self.batter_labels[batter.id]
+        if settings.test_time:
+            label = self.batter_label(batter)
+        return (batter, batter.batting_order, batter.name, batter.position, label,
+                id(batter.image) if batter.image else None, batter.team.primary_color, batter.team.secondary_color)
+
+    def draw_batter(self, draw, state):
+        batter = state[0]
+        main_color = batter.team.primary_color
         second_color = "White"
-        third_color = self.batter.team.secondary_color
+        third_color = batter.team.secondary_color
         text_main_color = get_text_color(main_color)
         text_second_color = "Black"
-        image = Image.new('RGBA', (2500, 500))
-        draw = ImageDraw.Draw(image)
         draw.polygon([(250, 100), (2500, 100), (2400, 250), (250, 250)], fill=main_color)
         draw.polygon([(250, 250), (2400, 250), (2300, 400), (250, 400)], fill=second_color)
-        if self.batter.image:
+        if batter.image:
             draw.ellipse((0, 0) + (500, 500), fill=third_color)
         else:
             draw.pieslice([100, 100, 400, 400], start=180, end=270, fill=main_color)
             draw.pieslice([100, 100, 400, 400], start=90, end=180, fill=second_color)
-        font_name = ImageFont.truetype(FONTS,80)
-        font_stat = ImageFont.truetype(FONTS,60)
-        draw.text((550, 120), '%s. %s - %s' % (self.batter.batting_order, self.batter.name, self.batter.position), fill=text_main_color, font=font_name)
-        if self.batter.pa:
-            player_label = 'This game: %s for %s' % (self.batter.h, self.batter.ab)
-            if self.batter.hr:
-                player_label += ', %s %s' % (self.batter.hr, 'HR')
-            elif self.batter.triple:
-                player_label += ', %s %s' % (self.batter.triple, 'triple')
-            elif self.batter.double:
-                player_label += ', %s %s' % (self.batter.double, 'double')
-            if self.batter.bb:
-                player_label += ', %s %s' % (self.batter.bb, 'BB')
-        else:
-            average = (1.00 * int(self.batter.stats.get('H', '0')) / int(self.batter.stats.get('AB', '0'))
-                                                     if int(self.batter.stats.get('AB', '0')) else 0.00)
-            average = '%.3f' % average
-            if average.startswith('0'):
-                average = average[1:]
-            player_label = 'This season: %s avg' % average
-            for stat, label in [('H', 'H'), ('DOUBLE', '2B'), ('TRIPLE', '3B'), ('HR', 'HR'), ('BB', 'BB')]:
-                if self.batter.stats.get(stat) != '0':
-                    player_label += ', %s %s' % (self.batter.stats.get(stat), label)
-        if config.has_option('baseball', 'test_time') and config.get('baseball', 'test_time'):
-            player_label = str(datetime.now())
-        draw.text((550, 270), player_label, fill=text_second_color, font=font_stat)
-        if self.batter.image:
-            image.paste(self.batter.image, (15, 15), self.batter.image)
-        return image
+        font_name = draw.font(80)
+        font_stat = draw.font(60)
+        draw.text((550, 120), '%s. %s - %s' % (batter.batting_order, batter.name, batter.position), fill=text_main_color, font=font_name)
+        draw.text((550, 270), state[4], fill=text_second_color, font=font_stat)
+        if batter.image:
+            draw.paste(batter.image, (15, 15), batter.image)
+
+    def next_batter(self, team, batter):
+        if not batter or not batter.batting_order.isdigit():
+            return batter
+        order = str(int(batter.batting_order) % 9 + 1)
+        return next((player for player in team.lineup.values() if player.batting_order == order), batter)
+
+    def likely_next(self):
+        """The game after the most likely next events: a ball, a strike, an out, a single, the end of the half inning"""
+        balls, strikes, outs = self.balls or 0, self.strikes or 0, self.outs or 0
+        pitcher = Speculation(self.pitcher, pitches=(self.pitcher.pitches or 0) + 1)
+        batting = self.away if self.inning_top else self.home
+        following = self.next_batter(batting, self.batter)
+        score = 'score_away' if self.inning_top else 'score_home'
+        yield Speculation(self, pitcher=pitcher, balls=min(balls + 1, 3))
+        yield Speculation(self, pitcher=pitcher, strikes=min(strikes + 1, 2))
+        if outs < 2:
+            yield Speculation(self, pitcher=pitcher, batter=following, balls=0, strikes=0, outs=outs + 1)
+        # the runners move up one base, the one on third scores
+        yield Speculation(self, pitcher=pitcher, batter=following, balls=0, strikes=0,
+                          runner1=True, runner2=self.runner1, runner3=self.runner2,
+                          **{score: (getattr(self, score) or 0) + (1 if self.runner3 else 0)})
+        if outs == 2 and self.inning.isdigit():
+            inning = self.inning if self.inning_top else str(int(self.inning) + 1)
+            yield Speculation(self, pitcher=batting.pitcher, inning=inning, inning_top=not self.inning_top,
+                              outs=0, balls=0, strikes=0, runner1=None, runner2=None, runner3=None)
+
+    def render_ahead(self):
+        """Render the likely next scorebug and batter card while waiting for the next play"""
+        if not settings.render_ahead or not self.game_started or self.current_play <= 1 or self.inning == 'F':
+            return
+        try:
+            with METRICS.time('render_ahead_seconds'):
+                for game in self.likely_next():
+                    self.scorebug.prepare(game)
+                    self.batter_card.prepare(game)
+                    # the overlay writer and the photo loaders run in between
+                    gevent.sleep(0)
+        except Exception:
+            logger.exception('Could not render ahead play %s', self.current_play)
+
+    def get_current_batter(self):
+        self.batter_card.refresh(self)
+        return self.batter_card.image
 
     def get_lineup(self, team, filename):
-        font_team = ImageFont.truetype(FONTS, 60)
-        font_name = ImageFont.truetype(FONTS, 30)
+        with METRICS.time('render_seconds', component='lineup'):
+            return self.draw_lineup(team, filename)
+
+    def draw_lineup(self, team, filename):
         bg_color = team.primary_color + (220,)
         pitcher_color = team.secondary_color + (220,)
         text_main_color = get_text_color(bg_color)
@@ -338,8 +2399,11 @@ class Game:
         width2 = 450
         space = 10
         logo_height = 100
-        image = Image.new('RGBA', (width, logo_height + (height + space) * 10))
-        draw = ImageDraw.Draw(image)
+        scale = self.lineup_scale
+        image = Image.new('RGBA', (round(width * scale), round((logo_height + (height + space) * 10) * scale)))
+        draw = LayerDraw(image, (0, 0), scale)
+        font_team = draw.font(60)
+        font_name = draw.font(30)
 
         draw.polygon([(space, space), (width - space, space), (width - space, logo_height - space), (space, logo_height - space)], fill=bg_color)
         draw.text((150, 10), filename.upper(), fill=text_main_color, font=font_team)
@@ -357,236 +2421,291 @@ class Game:
             if player.batting_order != '0':
                 draw.text((10, position), player.batting_order, fill=text_color, font=font_name)
             player_name = '%s %s.' % (player.lastname.upper(), player.firstname[0])
-            for font_size in reversed(range(30)):
-                font_player = ImageFont.truetype(FONTS, font_size)
-                player_name_length = draw.textlength(player_name, font_player)
-                if player_name_length < 350:
-                    break
+            font_player = draw.fit_font(player_name, 350, 30)
             draw.text((50, position), player_name, fill=text_color, font=font_player)
             draw.text((400, position), player.position, fill=text_color, font=font_name)
             position += space + height
-        width, height = team.image.size
-        team_image = team.image.resize((int((logo_height - 3 * space) * width / height), (logo_height - 3 * space)))
-        try:
-            image.paste(team_image, (int(space * 1.5), int(space * 1.5)), team_image)
-        except:
-            image.paste(team_image, (int(space * 1.5), int(space * 1.5)))
+        if team.image:
+            width, height = team.image.size
+            size = ((logo_height - 3 * space) * width / height, logo_height - 3 * space)
+            try:
+                draw.paste(team.image, (space * 1.5, space * 1.5), team.image, size=size)
+            except:
+                draw.paste(team.image, (space * 1.5, space * 1.5), size=size)
         return image
 
     def get_scorebug(self):
-        home_score = str(self.score_home)
-        away_score = str(self.score_away)
-
-        bg_color = (0, 0, 0, 180)
-        text_color = (255, 255, 255, 200)
-        border_base_color = (255, 255, 255, 170)
-        base_runner_color = (255, 255, 128, 255)
-        image = Image.new('RGBA', (1000, 750))
-
-        draw = ImageDraw.Draw(image)
-        draw.rounded_rectangle(((0, 140), (1000, 260)), radius=30, fill=bg_color)
-        draw.rounded_rectangle(((0, 300), (1000, 750)), radius=30, fill=bg_color)
+        self.scorebug.compose(self)
+        return self.scorebug.image
+
+    def draw_scorebug_chrome(self, draw, state):
+        font_team = draw.font(120)
+        draw.rounded_rectangle(((0, 140), (1000, 260)), radius=30, fill=SCOREBUG_BG_COLOR)
+        draw.rounded_rectangle(((0, 300), (1000, 750)), radius=30, fill=SCOREBUG_BG_COLOR)
         draw.rectangle(((0, 300), (600, 450)), fill=self.away.primary_color)
         draw.rectangle(((0, 450), (600, 600)), fill=self.home.primary_color)
+        draw.text((20, 300), self.away.code.upper()[:3], fill=get_text_color(self.away.primary_color), font=font_team)
+        draw.text((20, 450), self.home.code.upper()[:3], fill=get_text_color(self.home.primary_color), font=font_team)
+
+    def draw_pitcher(self, draw, state):
+        name, pitches = state
+        font_pitcher = draw.fit_font(name, 700, 60)
+        draw.text((20, 147), name, fill=SCOREBUG_TEXT_COLOR, font=font_pitcher)
+        draw.text((800, 147), 'P: %s' % pitches, fill=SCOREBUG_TEXT_COLOR, font=draw.font(60))
+
+    def draw_score(self, draw, state):
+        score, top, color = state
+        font_score = draw.font(120)
+        draw.text((500 - draw.textlength(score, font_score), top), score, fill=get_text_color(color), font=font_score)
 
+    def draw_bases(self, draw, state):
         l1 = 156
         l2 = 71
         offset_x = 650
         offset_y = 320
-        first_base = base_runner_color if self.runner1 else None
-        second_base = base_runner_color if self.runner2 else None
-        thrid_base = base_runner_color if self.runner3 else None
-
-        # bases
+        first_base, second_base, thrid_base = [SCOREBUG_RUNNER_COLOR if runner else None for runner in state]
         draw.polygon([
             (l1 + l1 - l2 + offset_x, l1 - l2 + offset_y),
             (l1 + l1 + offset_x, l1 + offset_y),
             (l1 + l1 - l2 + offset_x, l1 + l2 + offset_y),
             (l1 + l1 - l2 - l2 + offset_x, l1 + offset_y),
-            ], fill=first_base, outline=border_base_color, width=10)
+            ], fill=first_base, outline=SCOREBUG_BASE_COLOR, width=10)
         draw.polygon([
             (l1 + offset_x, 0 + offset_y),
             (l1 + l2 + offset_x, l2 + offset_y),
             (l1 + offset_x, l2 + l2 + offset_y),
             (l1 - l2 + offset_x, l2 + offset_y),
-            ], fill=second_base, outline=border_base_color, width=10)
+            ], fill=second_base, outline=SCOREBUG_BASE_COLOR, width=10)
         draw.polygon([
             (l2 + offset_x, l1 - l2 + offset_y),
             (l2 + l2 + offset_x, l1 + offset_y),
             (l2 + offset_x, l1 + l2 + offset_y),
             (0 + offset_x, l1 + offset_y),
-            ], fill=thrid_base, outline =border_base_color, width=10)
+            ], fill=thrid_base, outline=SCOREBUG_BASE_COLOR, width=10)
 
-        font_team = ImageFont.truetype(FONTS, 120)
-        font_name = ImageFont.truetype(FONTS, 60)
-        font_out = ImageFont.truetype(FONTS, 100)
-        font_score = ImageFont.truetype(FONTS, 120)
+    def draw_inning(self, draw, state):
+        inning, inning_top = state
+        draw.polygon([(70, 675), (70 + 40, 675), (70 + 20, 675 + (-40 if inning_top else 40)),], fill=SCOREBUG_BASE_COLOR)
+        draw.text((70 + 15 + 40, 600), inning, fill=SCOREBUG_TEXT_COLOR, font=draw.font(120))
 
-        away_score_length = draw.textlength(away_score, font_score)
-        home_score_length = draw.textlength(home_score, font_score)
-        get_text_color(self.away.primary_color)
+    def draw_outs(self, draw, state):
+        draw.text((330, 600), str(state), fill=SCOREBUG_TEXT_COLOR, font=draw.font(120))
+        draw.text((410, 600), 'out', fill=SCOREBUG_TEXT_COLOR, font=draw.font(100))
 
-        draw.text((20, 300), self.away.code.upper()[:3], fill=get_text_color(self.away.primary_color), font=font_team)
-        draw.text((500 - away_score_length, 300), away_score, fill=get_text_color(self.away.primary_color), font=font_score)
-        draw.text((20, 450), self.home.code.upper()[:3], fill=get_text_color(self.home.primary_color), font=font_team)
-        draw.text((500 - home_score_length, 450), home_score, fill=get_text_color(self.home.primary_color), font=font_score)
-        for font_size in reversed(range(60)):
-            font_pitcher = ImageFont.truetype(FONTS, font_size)
-            pitcher_name_length = draw.textlength(self.pitcher.name, font_pitcher)
-            if pitcher_name_length < 700:
-                break
-        draw.text((20, 147), self.pitcher.name, fill=text_color, font=font_pitcher)
-        draw.text((800, 147), 'P: %s' % self.pitcher.pitches, fill=text_color, font=font_name)
-        # inning
-        draw.polygon([(70, 675), (70 + 40, 675), (70 + 20, 675 + (-40 if self.inning_top else 40)),], fill=border_base_color)
-        draw.text((70 + 15 + 40, 600), self.inning, fill=text_color, font=font_team)
-        draw.text((330, 600), str(self.outs), fill=text_color, font=font_team)
-        draw.text((410, 600), 'out', fill=text_color, font=font_out)
-        count = '%s-%s' % (self.balls, self.strikes)
+    def draw_count(self, draw, state):
+        font_team = draw.font(120)
+        count = '%s-%s' % state
         count_length = draw.textlength(count, font_team)
-        draw.text((l1 + offset_x - count_length / 2, 600), count, fill=text_color, font=font_team)
-        return image
+        draw.text((156 + 650 - count_length / 2, 600), count, fill=SCOREBUG_TEXT_COLOR, font=font_team)
+
+    def init_overlay(self):
+        if settings.overlay_engine == 'numpy' and numpy is None:
+            logger.warning('numpy is not installed, composing the overlay with PIL')
+        self.canvas = (NumpyCanvas if settings.overlay_engine == 'numpy' and numpy is not None else PilCanvas)(self.resolution)
+        self.overlay_state = None
+        # components are laid out in design units and drawn directly at their size on the output:
+        # the batter card is half the width of the output, the scorebug a sixth, each lineup 1/2.8
+        self.batter_scale = self.resolution[0] / 2 / 2500
+        self.scorebug_scale = scale = self.resolution[0] / 6 / 1000
+        self.lineup_scale = self.resolution[0] / 2.8 / 500
+        self.batter_card = Layer((0, 0, 2500, 500), Game.batter_state, self.draw_batter, self.batter_scale)
+        self.scorebug = Compositor(
+            Layer((0, 0, 1000, 750),
+                  lambda game: (game.away.code, game.away.primary_color, game.home.code, game.home.primary_color),
+                  self.draw_scorebug_chrome, scale),
+            [
+                Layer((0, 140, 1000, 260), lambda game: (game.pitcher.name, game.pitcher.pitches), self.draw_pitcher, scale),
+                Layer((300, 300, 600, 450), lambda game: (str(game.score_away), 300, game.away.primary_color), self.draw_score, scale),
+                Layer((300, 450, 600, 600), lambda game: (str(game.score_home), 450, game.home.primary_color), self.draw_score, scale),
+                Layer((640, 305, 980, 560), lambda game: (bool(game.runner1), bool(game.runner2), bool(game.runner3)), self.draw_bases, scale),
+                Layer((60, 600, 320, 750), lambda game: (game.inning, game.inning_top), self.draw_inning, scale),
+                Layer((320, 600, 630, 750), lambda game: game.outs, self.draw_outs, scale),
+                Layer((640, 600, 1000, 750), lambda game: (game.balls, game.strikes), self.draw_count, scale),
+            ])
+
+    @property
+    def overlay(self):
+        return self.canvas.image
+
+    def lineup_state(self, team):
+        return (team.primary_color, team.secondary_color, id(team.image),
+                tuple((p.batting_order, p.lastname, p.firstname, p.position) for p in team.get_lineup()))
 
     def make_overlay(self):
-        image = Image.new('RGBA', self.resolution)
+        if not self.game_started:
+            state = ('logos',)
+        elif self.current_play > 1:
+            scorebug_changed = self.scorebug.compose(self)
+            batter_changed = self.inning != 'F' and self.batter_card.refresh(self)
+            state = ('game', self.scorebug.state, self.batter_card.state if self.inning != 'F' else None)
+        else:
+            state = ('lineup', self.lineup_state(self.home), self.lineup_state(self.away))
+        previous = self.overlay_state
+        if state == previous:
+            return
+        start = time.perf_counter()
+        canvas = self.canvas
+        canvas.begin()
+        if not previous or state[0] != previous[0]:
+            canvas.clear()
+            previous = None
+            scorebug_changed = batter_changed = True
+
         if not self.game_started:
             for team_logo in [('away_logo', 3.70), ('home_logo', 0.30)]:
                 try:
-                    logo = Image.open(BytesIO(requests.get(self.game_info.get(team_logo[0])).content))
+                    logo = self.get_image(self.game_info.get(team_logo[0]))
                     width, height = logo.size
                     logo = logo.resize((int(self.resolution[0] / 5.00), int((self.resolution[0] / 5.00) * height / width)))
-                    try:
-                        image.paste(logo, (int(team_logo[1] * self.resolution[0] / 5.00), int(self.resolution[1] / 1.50)), logo)
-                    except:
-                        image.paste(logo, (int(team_logo[1] * self.resolution[0] / 5.00), int(self.resolution[1] / 1.50)))
+                    canvas.paste(logo, (int(team_logo[1] * self.resolution[0] / 5.00), int(self.resolution[1] / 1.50)))
                 except:
                     logger.error('Could not generate team initial logo')
 
         elif self.current_play > 1:
-            scorebug = self.get_scorebug()
-            ratio = self.resolution[0] / scorebug.size[0] / 6
-            scorebug = scorebug.resize((int(scorebug.size[0] * ratio), int(scorebug.size[1] * ratio)))
-            image.paste(scorebug, (20, self.resolution[1] - scorebug.size[1] - 20), scorebug)
-            if self.inning != 'F':
-                player = self.get_current_batter()
-                ratio = self.resolution[0] / player.size[0] / 2
-                player = player.resize((int(player.size[0] * ratio), int(player.size[1] * ratio)))
-                image.paste(player, (self.resolution[0] - player.size[0] - 30, self.resolution[1] - player.size[1] - 30), player)
+            if scorebug_changed:
+                scorebug = self.scorebug.image
+                position = (20, self.resolution[1] - scorebug.size[1] - 20)
+                canvas.clear(position + (position[0] + scorebug.size[0], position[1] + scorebug.size[1]))
+                canvas.paste(scorebug, position)
+            if self.inning == 'F':
+                if previous and previous[2]:
+                    canvas.clear(self.batter_box)
+            elif batter_changed:
+                player = self.batter_card.image
+                position = (self.resolution[0] - player.size[0] - 30, self.resolution[1] - player.size[1] - 30)
+                self.batter_box = position + (position[0] + player.size[0], position[1] + player.size[1])
+                canvas.clear(self.batter_box)
+                canvas.paste(player, position)
         elif self.current_play <= 1:
             home_lineup = self.get_lineup(self.home, HOME_NAME)
             away_lineup = self.get_lineup(self.away, AWAY_NAME)
-            ratio = self.resolution[0] / home_lineup.size[0] / 2.8
-            home_lineup = home_lineup.resize((int(home_lineup.size[0] * ratio), int(home_lineup.size[1] * ratio)))
-            away_lineup = away_lineup.resize((int(away_lineup.size[0] * ratio), int(away_lineup.size[1] * ratio)))
-            image.paste(home_lineup, (int(self.resolution[0] / 2 + 100), 100), home_lineup)
-            image.paste(away_lineup, (int(self.resolution[0] / 2 - 100 - away_lineup.size[0]), 100), away_lineup)
+            canvas.paste(home_lineup, (int(self.resolution[0] / 2 + 100), 100))
+            canvas.paste(away_lineup, (int(self.resolution[0] / 2 - 100 - away_lineup.size[0]), 100))
+        canvas.commit()
 
-        image.save(os.path.join(WORKING_DIR, 'overlay-tmp.png'), "PNG")
-        os.replace(os.path.join(WORKING_DIR, 'overlay-tmp.png'), os.path.join(WORKING_DIR, 'overlay.png'))
+        self.overlay_state = state
+        METRICS.observe('render_seconds', time.perf_counter() - start, component='overlay')
+        with METRICS.time('overlay_write_seconds'):
+            canvas.write(self.overlay_writer)
 
-    def start_video_file(self, file, duration=None):
-        command = [
-            'ffmpeg',
-            '-re',
-            '-i', file,
-            '-c:a', 'aac',
-            '-b:a', '128k',
-            '-strict', 'experimental',
-            '-f', 'flv',
-            '-b:v', '8000k',
-            '-vcodec', 'h264',
-            '-preset', 'ultrafast',
-            '-g', '60',
-            '-s', '1920x1080',
+    def initialize_stream(self):
+        self.playout = Playout(self.field, self.logfile)
+        self.playout.start()
+        # the encoders warm up during the intro, the stream goes live as soon as it is over
+        names = ('encoder', 'standby') if settings.warm_standby else ('encoder',)
+        self.encoders = [
+            Supervisor(name, functools.partial(self.start_stream_process, [udp_output(self.playout.switch.ports[name])],
+                                               self.encoder_cpus(index)),
+                       on_exit=self.playout.update)
+            for index, name in enumerate(names)
         ]
-        video_file_proc = subprocess.Popen(command + [f'{MAIN_STREAM}'], stdin=subprocess.PIPE, stderr=self.logfile or subprocess.STDOUT, universal_newlines=True)
-        if duration:
-            time.sleep(duration)
-            video_file_proc.terminate()
-        else:
-            video_file_proc.wait()
-
-    def initialize_stream(self, restart=False):
-        if config.has_option('baseball', 'intro_file') and not restart:
+        for encoder in self.encoders:
+            encoder.start()
+        if settings.intro_file:
             logger.info("Starting intro file.")
-            self.start_video_file(config.get('baseball', 'intro_file'))
+            self.playout.play(settings.intro_file)
+        self.playout.go_live(self.encoders)
 
-        FINE_TUNE = FINE_TUNE_CAMERA_FIELD1 if self.game_info.get('camera') == 'camera1' else FINE_TUNE_CAMERA_FIELD2
+    def encoder_cpus(self, index):
+        if not self.cpus:
+            return None
+        count = max(1, len(self.cpus) // (2 if settings.warm_standby else 1))
+        # with a single CPU the warm standby shares it with the active encoder
+        return self.cpus[index * count:(index + 1) * count] or self.cpus
+
+    def start_stream_process(self, outputs, cpus=None):
+        # with the hot camera switch both cameras stay connected, streamselect shows the active one
+        cameras = list(FIELDS.values()) if settings.hot_camera_switch else [self.field]
+        inputs = []
+        filters = []
+        for index, camera in enumerate(cameras):
+            inputs += ['-re', '-thread_queue_size', '512', '-rtsp_transport', 'tcp', '-i', camera.input_stream]
+            filters.append('[%s:v]%sscale=%s:%s[camera%s]' % (index, camera.fine_tune, INPUT_RESOLUTION[0], INPUT_RESOLUTION[1], index))
+        if settings.hot_camera_switch:
+            active = self.camera_index()
+            filters.append('%sstreamselect=inputs=%s:map=%s[camera]' % (
+                ''.join('[camera%s]' % index for index in range(len(cameras))), len(cameras), active))
+            filters.append('%sastreamselect=inputs=%s:map=%s[audio]' % (
+                ''.join('[%s:a]' % index for index in range(len(cameras))), len(cameras), active))
+            video, audio = '[camera]', '[audio]'
+        else:
+            video, audio = '[camera0]', '0:a'
+        filters.append('%s[%s:v]overlay[outv]' % (video, len(cameras)))
+        overlay_input, pass_fds = self.overlay_writer.ffmpeg_input()
         command = [
             'ffmpeg',
-            '-re',
-            '-thread_queue_size', '512',
-            '-rtsp_transport', 'tcp',
-            '-i', INPUT_CAMERA_STREAM_FIELD1 if self.game_info.get('camera') == 'camera1' else INPUT_CAMERA_STREAM_FIELD2,
-            '-f', 'image2',
-            '-framerate', '3',
-            '-loop', '1',
-            '-i', os.path.join(WORKING_DIR, 'overlay.png'),
-            '-filter_complex', '[0:v]%sscale=%s:%s[scaled];[scaled][1:v]overlay[outv]' % (FINE_TUNE, INPUT_RESOLUTION[0], INPUT_RESOLUTION[1]),
+            '-progress', 'pipe:1',
+        ] + inputs + overlay_input + [
+            '-filter_complex', ';'.join(filters),
             '-map', '[outv]',
-            '-map', '0:a',
-            '-c:a', 'aac',
-            '-b:a', '96k',
-            '-strict', 'experimental',
+            '-map', audio,
             '-rtbufsize', '1G',
-            '-f', 'flv',
-            '-b:v', '3000k',
-            '-vcodec', 'h264',
-            '-preset', 'ultrafast',
-            '-g', '60',
-            '-s', '1920x1080',
+        ] + encode_options(cpus) + [
+            '-f', 'tee',
+            '|'.join(outputs),
         ]
-        logger.info('FFMPEG Command: %s', ' '.join(command + [f'{MAIN_STREAM}']))
-        self.stream_proc = subprocess.Popen(command + [f'{MAIN_STREAM}'], stdin=subprocess.PIPE, stderr=self.logfile or subprocess.STDOUT, universal_newlines=True)
-        if BACKUP_STREAM and not restart:
-            self.backup_proc = subprocess.Popen(command + [f'{BACKUP_STREAM}'], stdin=subprocess.PIPE, stderr=self.logfile or subprocess.STDOUT, universal_newlines=True)
+        logger.info('FFMPEG Command: %s', ' '.join(command))
+        # pinned before exec, every thread of the encoder stays on its CPUs
+        preexec_fn = functools.partial(os.sched_setaffinity, 0, cpus) if cpus else None
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.logfile or subprocess.STDOUT, universal_newlines=True, pass_fds=pass_fds, preexec_fn=preexec_fn)
+        for fd in pass_fds:
+            # closed through a file object, gevent defers os.close on pipes
+            open(fd, 'rb', buffering=0).close()
+        return proc
 
-    def loop_check_stream(self):
-        while True:
-            if self.force_end:
-                break
-            if self.stream_proc:
-                 retcode = self.stream_proc.poll()
-                 if retcode:
-                    logger.info('FFmpeg failed for an unknown reason (return code %s), restarting', retcode)
-                    self.initialize_stream(restart=True)
-            time.sleep(1)
+    def camera_index(self):
+        return list(FIELDS).index(self.camera) if self.camera in FIELDS else 1
+
+    def switch_camera(self, camera):
+        """Show camera through the command prompt of the (a)streamselect filters, without restarting the encoders"""
+        if not settings.hot_camera_switch or camera == self.camera or camera not in FIELDS:
+            return
+        logger.info('Switching from %s to %s', self.camera, camera)
+        self.camera = camera
+        METRICS.inc('camera_switches_total')
+        for encoder in self.encoders:
+            if encoder.proc and encoder.proc.poll() is None:
+                try:
+                    for target in ('streamselect', 'astreamselect'):
+                        encoder.proc.stdin.write('c%s -1 map %s\n' % (target, self.camera_index()))
+                    encoder.proc.stdin.flush()
+                except OSError:
+                    logger.info('Could not switch camera of FFmpeg %s', encoder.name)
 
     def loop_check_main_website(self):
-        error = 0
-        while True:
-            if self.force_end:
-                break
-            time.sleep(15)
-            try:
-                current_score = requests.get(f'{WEBSITE_URL}/game/current_score', timeout=30)
-                current_score.raise_for_status()
-                current_score = current_score.json()
-                logger.info('Got current score %s', current_score)
-            except requests.HTTPError:
-                logger.exception('Could not get current score')
+        if not self.discovery:
+            self.discovery = Discovery(self.session)
+        self.discovery.start()
+        seen = 0
+        missing_since = None
+        while not self.force_end:
+            update, games = self.discovery.wait(seen, timeout=settings.discovery_min_interval)
+            if update == seen:
                 continue
-            if not current_score.get('game'):
-                error += 1
-                logger.info('No game detected on the website')
-                if error >= 3:
-                    logger.info('Force stoppping game')
-                    self.force_end = True
-            else:
-                error = 0
+            seen = update
+            current = next((game for game in games if game.get('live_score_id') == self.id), None)
+            if current:
+                missing_since = None
+                self.switch_camera(current.get('camera'))
+            elif missing_since is None:
+                logger.info('Game %s not detected on the website', self.id)
+                missing_since = self.discovery.updated
+            elif self.discovery.updated - missing_since >= settings.discovery_grace:
+                logger.info('Force stoppping game')
+                self.force_end = True
 
     def loop_main(self):
         start = int(time.time() * 1000)
         self.make_overlay()
-        time.sleep(10)
+        time.sleep(settings.game_start_delay)
         end_time = None
         while True:
             if self.force_end:
                 break
             if not self.game_started:
                 self.init_game()
-                logger.info('Game has not started yet, waiting 30s then retrying')
-                time.sleep(30)
+                logger.info('Game has not started yet, waiting %ss then retrying', settings.game_retry_interval)
+                time.sleep(settings.game_retry_interval)
                 continue
             logger.info('Play %s', self.current_play)
             if self.inning == 'F':
@@ -594,103 +2713,229 @@ class Game:
                     self.force_end = True
                 if not end_time:
                     end_time = time.time()
-                elif time.time() - end_time > 120:
+                elif time.time() - end_time > settings.game_end_delay:
                     self.force_end = True
             else:
                 end_time = None
             if self.mode == 'replay' and self.replay_mode == 'realtime':
-                current_time = self.beginning + (int(time.time() * 1000) - start)
-                while self.play_time < current_time:
-                    data = self.session.get(PLAY_URL % (self.id, self.current_play), headers=HEADERS)
-                    try:
-                        data = data.json()
-                    except Exception:
-                        self.current_play += 1
-                        continue
-                    self.update_game(data)
-                    logger.info('Play %s', self.current_play)
-                    self.make_overlay()
-                    self.current_play += 1
-                time.sleep(0.5)
-            elif self.mode == 'replay' and self.replay_mode == 'sequence':
-                data = self.session.get(PLAY_URL % (self.id, self.current_play), headers=HEADERS)
-                try:
-                    data = data.json()
-                except:
-                    self.current_play += 1
+                # the next play is shown as soon as the timestamp of the current one is passed
+                due = start + (self.play_time - self.beginning) / settings.replay_speed
+                delay = due - time.time() * 1000
+                if delay > 0:
+                    time.sleep(min(delay / 1000, 1))
                     continue
-                self.update_game(data)
-                self.make_overlay()
-                self.current_play += 1
-                time.sleep(2)
-            elif self.mode == 'live':
-                last_play = self.session.get(LATEST_PLAY_URL % self.id, headers=HEADERS)
-                last_play = int(last_play.json())
-                if self.current_play == last_play:
-                    time.sleep(1)
+                play, data = self.replay.next()
+                if play is None:
+                    self.force_end = True
                     continue
-                self.current_play = last_play
-                data = self.session.get(PLAY_URL % (self.id, last_play), headers=HEADERS)
-                try:
-                    data = data.json()
-                except:
+                self.update_game(data)
+                logger.info('Play %s', play)
+                self.current_play = play
+                self.show_play(play)
+                self.current_play = play + 1
+                METRICS.observe('play_overlay_seconds', time.time() - due / 1000)
+                self.render_ahead()
+            elif self.mode == 'replay' and self.replay_mode == 'sequence':
+                play, data = self.replay.next()
+                if play is None:
+                    self.force_end = True
                     continue
                 self.update_game(data)
-                self.make_overlay()
-                time.sleep(3)
+                self.current_play = play
+                self.show_play(play)
+                self.current_play = play + 1
+                time.sleep(2 / settings.replay_speed)
+            elif self.mode == 'live':
+                plays = self.ingest.poll(self.current_play)
+                fetched = time.time()
+                for play, data in plays:
+                    self.update_game(data)
+                    self.current_play = play
+                if plays:
+                    self.make_overlay()
+                    METRICS.observe('play_overlay_seconds', time.time() - fetched)
+                    METRICS.set('play_age_seconds', time.time() - self.play_time / 1000)
+                    self.render_ahead()
+                time.sleep(self.ingest.interval)
+        if self.playout and settings.end_file:
+            # the end video goes through the same RTMP sessions as the game
+            for encoder in self.encoders:
+                encoder.stop()
+            logger.info("Starting end file. %s", settings.end_file)
+            self.playout.play(settings.end_file)
         self.cleanup()
-        if config.has_option('baseball', 'end_file'):
-            logger.info("Starting end file. %s", config.get('baseball', 'end_file'))
-            self.start_video_file(config.get('baseball', 'end_file'))
 
     def cleanup(self):
         logger.info("Cleaning up...")
         self.force_end = True
-        if hasattr(self, 'stream_proc') and self.stream_proc and self.stream_proc.poll() is None:
-            self.stream_proc.kill()
-            logger.info("FFmpeg process terminated.")
-        if hasattr(self, 'backup_proc') and self.backup_proc and self.backup_proc.poll() is None:
-            self.backup_proc.kill()
-            logger.info("Backup FFmpeg process terminated.")
+        if self.replay:
+            self.replay.stop()
+        if self.archive:
+            self.archive.close()
+        for encoder in self.encoders:
+            encoder.stop()
+        if self.playout:
+            self.playout.stop()
+        if isinstance(self.overlay_writer, OverlayPipeWriter):
+            self.overlay_writer.close()
         if self.logfile:
             self.logfile.close()
-        if os.path.exists(os.path.join(WORKING_DIR, 'default.png')):
-            shutil.copyfile(os.path.join(WORKING_DIR, 'default.png'), os.path.join(WORKING_DIR, 'overlay.png'))
+        working_dir = self.field.working_dir
+        if os.path.exists(os.path.join(working_dir, 'default.png')):
+            shutil.copyfile(os.path.join(working_dir, 'default.png'), os.path.join(working_dir, 'overlay.png'))
+
+    def memory(self):
+        """Bytes of the images, frames and downloads held by the game"""
+        images = {}
+        for team in (getattr(self, 'home', None), getattr(self, 'away', None)):
+            if team:
+                images[id(team.image)] = team.image
+                images.update((id(player.image), player.image) for player in team.all_players.values())
+        return (sum(image_bytes(image) for image in images.values()) + self.canvas.memory()
+                + self.batter_card.memory() + self.scorebug.memory()
+                + sum(len(content) for content in self.assets.values() if content))
+
+    def forget(self):
+        self.assets.clear()
+        self.batter_labels.clear()
+        self.prerendered.clear()
+        for team in (getattr(self, 'home', None), getattr(self, 'away', None)):
+            if team:
+                # players, teams and the game refer to each other
+                for player in team.all_players.values():
+                    player.image = player.game = player.team = None
+                team.all_players.clear()
+                team.lineup.clear()
+                team.by_lineupcode.clear()
+                team.game = team.image = team.pitcher = None
+        self.home = self.away = self.batter = self.pitcher = None
+        self.batter_card = self.scorebug = self.canvas = None
+        self.boxscore = self.data = None
+        STATS.forget(self.event_id)
+
+    def release(self):
+        """Free everything held by the game, once it is over"""
+        self.arena.close()
+
+
+class Scheduler:
+    """Run the games found on the website side by side, at most one per field"""
+
+    def __init__(self, max_games=None, budget=None):
+        self.max_games = max_games = max_games or settings.max_games
+        self.budget = budget or CpuBudget(sorted(os.sched_getaffinity(0))[:settings.cpu_budget])
+        self.game_cpus = self.cpus_per_game()
+        if self.game_cpus > len(self.budget.free):
+            logger.error('The encoders of a game need %s CPUs, cpu_budget only has %s: no game can be started',
+                         self.game_cpus, len(self.budget.free))
+        self.session = make_session(settings.asset_concurrency * max_games)
+        self.discovery = Discovery(self.session)
+        # camera: running game, None while it is starting
+        self.games = {}
+
+    def run(self):
+        self.discovery.start()
+        seen = 0
+        while True:
+            # every answer of the website, a game waiting for a field or CPUs is retried
+            seen, games = self.discovery.wait(seen)
+            self.report_memory()
+            for game_info in games:
+                if game_info.get('live_score_id') and game_info.get('youtube_video_id'):
+                    self.schedule(game_info)
+
+    def cpus_per_game(self):
+        """CPUs the encoders of a game are pinned on, none when a single game runs"""
+        if self.max_games == 1:
+            return 0
+        encoders = 2 if settings.warm_standby else 1
+        if settings.encoder_cpus:
+            return settings.encoder_cpus * encoders
+        return max(encoders, len(self.budget.free) // self.max_games)
+
+    def schedule(self, game_info):
+        field = get_field(game_info)
+        if field.camera in self.games or len(self.games) >= self.max_games:
+            return
+        # also the games still starting
+        if any(FIELDS[camera].main_stream == field.main_stream for camera in self.games):
+            logger.info('Game %s is not started, %s is already streamed', game_info.get('live_score_id'), field.main_stream)
+            return
+        cpus = self.budget.allocate(self.game_cpus) if self.game_cpus else []
+        if cpus is None:
+            # with no game running the budget can never fit one
+            log = logger.info if self.games else logger.error
+            log('Game %s is not started, no CPU left for its encoders', game_info.get('live_score_id'))
+            return
+        logger.info('Found game %s on %s - starting stream', game_info.get('live_score_id'), field.camera)
+        self.games[field.camera] = None
+        gevent.spawn(self.run_game, game_info, field, cpus)
+
+    def report_memory(self):
+        METRICS.set('process_resident_bytes', resident_memory())
+        for game in self.games.values():
+            if game:
+                METRICS.set('game_memory_bytes', game.memory(), game=game.id)
+
+    def run_game(self, game_info, field, cpus):
+        game = None
+        try:
+            game = Game(game_info, mode=settings.mode, replay_mode=settings.replay_mode,
+                        session=self.session, cpus=cpus, discovery=self.discovery)
+            self.games[field.camera] = game
+            METRICS.startup('game')
+            gevent.joinall([
+                gevent.spawn(game.loop_main),
+                gevent.spawn(game.loop_check_main_website),
+                game.overlay_pusher,
+            ])
+        except Exception:
+            logger.exception('Failed to start game %s', game_info.get('live_score_id'))
+        finally:
+            del self.games[field.camera]
+            self.budget.release(cpus)
+            if game:
+                memory = game.memory()
+                game.release()
+                METRICS.unset('game_memory_bytes', game=game.id)
+                # the players, teams and game are no longer referenced, their cycles are broken
+                del game
+                gc.collect()
+                logger.info('Game %s released %.1f MB, process resident memory %.1f MB',
+                            game_info.get('live_score_id'), memory / 2 ** 20, resident_memory() / 2 ** 20)
+
+    def shutdown(self):
+        for game in self.games.values():
+            if game:
+                game.cleanup()
+        self.discovery.stop()
+        PHOTOS.shutdown()
+
 
 def main():
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', filename=LOGFILE, filemode='a')
+    args = docopt(__doc__)
+    configure(Settings.read(args['<config_file>']))
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', filename=settings.logfile, filemode='a')
+    if args['archive']:
+        session = make_session()
+        for game_id in args['<live_score_id>']:
+            GameArchive.download(session, game_id, GameArchive.path_for(game_id))
+        return
+    METRICS.startup('configured')
+    if settings.metrics_port:
+        METRICS.serve(settings.metrics_port)
     logger.info('Starting service')
-    while True:
-        try:
-            current_score = requests.get(f'{WEBSITE_URL}/game/current_score', timeout=30)
-            current_score.raise_for_status()
-            current_score = current_score.json()
-            logger.info('Got current score %s', current_score)
-        except requests.HTTPError:
-            logger.exception('Could not get current score')
-        if current_score.get('game') and current_score.get('live_score_id') and current_score.get('youtube_video_id'):
-            logger.info('Found game %s - starting stream', current_score.get('live_score_id'))
-            try:
-                replay_mode = config.has_option('baseball', 'replay_mode') and config.get('baseball', 'replay_mode')
-                game = Game(current_score, mode=config.get('baseball', 'mode'), replay_mode=replay_mode)
-
-                def signal_handler(sig, frame):
-                    logger.info("Signal received: %s", sig)
-                    game.cleanup()
-                    if game.logfile:
-                        game.logfile.close()
-                    os._exit(0)
-                signal.signal(signal.SIGINT, signal_handler)
-                signal.signal(signal.SIGTERM, signal_handler)
-                greenlet_loop_main = gevent.spawn(game.loop_main)
-                greenlet_loop_check_stream = gevent.spawn(game.loop_check_stream)
-                greenlet_loop_check_main_website = gevent.spawn(game.loop_check_main_website)
-                gevent.joinall([greenlet_loop_main, greenlet_loop_check_stream, greenlet_loop_check_main_website])
-            except Exception:
-                logger.exception('Failed to start game, retrying in 60s')
-                time.sleep(60)
-
-        time.sleep(60)
+    scheduler = Scheduler()
+
+    def signal_handler(sig, frame):
+        logger.info("Signal received: %s", sig)
+        scheduler.shutdown()
+        os._exit(0)
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    # the streams come first, face detection is only needed by the first new batter
+    gevent.spawn_later(1, PHOTOS.warm_up)
+    scheduler.run()
 
 
 if __name__ == "__main__":
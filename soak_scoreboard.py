@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+"""Soak test generate_scoreboard.py on a recorded game served by a local stand-in of wbsc and of the website
+
+The stand-in serves the plays of a game archive (see generate_scoreboard.py
+archive) as latest.json and play<n>.json on a clock running --speed times
+faster than the game, and /game/current_score flags the game until it is over.
+It can add latency, 503 errors and truncated json to its responses.
+
+The soak drives whole games through Game.loop_main and the website check in
+live mode, the overlay is written to a null sink instead of ffmpeg. It
+reports the drift between the time a play is published and the time its
+overlay is written, the resident memory along and across the games and the
+greenlet stalls (time during which the event loop was blocked).
+
+With serve, only the stand-in runs, the service can then be pointed to it
+with website_url and wbsc_url (printed at start).
+
+Usage:
+    soak_scoreboard.py serve [options] [<archive>]
+    soak_scoreboard.py [options] [<archive>]
+    soak_scoreboard.py (-h | --help)
+
+Options:
+    -h --help             Show this help message and exit
+    --speed=<factor>      Speed of the game clock [default: 60]
+    --games=<n>           Number of games played back to back [default: 1]
+    --latency=<seconds>   Maximum latency added to every response [default: 0]
+    --errors=<rate>       Share of the responses replaced by a 503 error [default: 0]
+    --malformed=<rate>    Share of the json responses truncated [default: 0]
+    --seed=<n>            Seed of the injected faults [default: 0]
+    --port=<port>         Port of the stand-in [default: 18080]
+    --font=<file>         Font used to draw the overlay [default: /usr/share/fonts/truetype/dejavu/DejaVuSans.ttf]
+    --engine=<engine>     Overlay engine, pil or numpy [default: pil]
+    --output=<file>       Write the results in file instead of stdout
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import bisect  # noqa: E402
+import gc  # noqa: E402
+import hashlib  # noqa: E402
+import json  # noqa: E402
+import logging  # noqa: E402
+import os  # noqa: E402
+import random  # noqa: E402
+import re  # noqa: E402
+import shutil  # noqa: E402
+import statistics  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+import time  # noqa: E402
+
+import gevent  # noqa: E402
+from docopt import docopt  # noqa: E402
+from gevent.pywsgi import WSGIServer  # noqa: E402
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, DIRECTORY)
+import generate_scoreboard as gs  # noqa: E402
+
+GAME_INFO = {
+    'game': True,
+    'youtube_video_id': 'soak',
+    'camera': 'camera1',
+    'home_primary_color': '#0a14c8',
+    'home_secondary_color': '#c8c800',
+    'away_primary_color': '#dcdcdc',
+    'away_secondary_color': '#000000',
+}
+# game seconds during which the game stays on the website after its last play
+END_DELAY = 300
+PLAY_PATH = re.compile(r'^/gamedata/(\d+)/(latest|play(\d+))\.json$')
+
+
+class StandIn:
+    """game.wbsc.org and the website of the club serving a recorded game
+
+    The play n is published once the game clock, started by restart() and
+    running speed times faster, reaches its timestamp.
+    """
+
+    def __init__(self, archive, speed, latency=0, errors=0, malformed=0, seed=0):
+        self.archive = archive
+        self.speed = speed
+        self.latency = latency
+        self.errors = errors
+        self.malformed = malformed
+        self.random = random.Random(seed)
+        self.game_info = dict(GAME_INFO, live_score_id=archive.game_id)
+        self.bodies = {}
+        self.start = None
+        self.requests = {}
+        self.faults = {'latency_seconds': 0.0, 'errors': 0, 'malformed': 0}
+
+    def restart(self):
+        self.start = time.monotonic()
+
+    def published(self, play):
+        """Time at which play is published"""
+        return self.start + (self.archive.index[play][2] - self.archive.times[0]) / 1000 / self.speed
+
+    def latest(self):
+        elapsed = (time.monotonic() - self.start) * self.speed * 1000
+        index = bisect.bisect_right(self.archive.times, self.archive.times[0] + elapsed) - 1
+        return self.archive.plays[max(index, 0)]
+
+    @property
+    def over(self):
+        elapsed = (time.monotonic() - self.start) * self.speed
+        return elapsed > (self.archive.times[-1] - self.archive.times[0]) / 1000 + END_DELAY
+
+    def body(self, play):
+        if play not in self.bodies:
+            self.bodies[play] = json.dumps(self.archive.read(play)).encode()
+        return self.bodies[play]
+
+    def app(self, environ, start_response):
+        path = environ['PATH_INFO']
+        match = PLAY_PATH.match(path)
+        if path == '/game/current_score':
+            route = 'current_score'
+        elif match:
+            route = 'latest' if match.group(3) is None else 'play'
+        else:
+            route = 'other'
+        self.requests[route] = self.requests.get(route, 0) + 1
+        if self.latency:
+            delay = self.random.uniform(0, self.latency)
+            self.faults['latency_seconds'] += delay
+            gevent.sleep(delay)
+        if self.random.random() < self.errors:
+            self.faults['errors'] += 1
+            start_response('503 Service Unavailable', [('Content-Type', 'text/plain')])
+            return [b'injected error']
+        if self.start is None:
+            status, body = '404 Not Found', None
+        elif route == 'current_score':
+            status, body = '200 OK', json.dumps({} if self.over else self.game_info).encode()
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()[:16]
+            if environ.get('HTTP_IF_NONE_MATCH') == etag:
+                start_response('304 Not Modified', [('ETag', etag)])
+                return []
+            return self.respond(start_response, status, body, [('ETag', etag)])
+        elif match and int(match.group(1)) == self.archive.game_id:
+            latest = self.latest()
+            if match.group(3) is None:
+                status, body = '200 OK', str(latest).encode()
+            elif int(match.group(3)) <= latest and int(match.group(3)) in self.archive.index:
+                status, body = '200 OK', self.body(int(match.group(3)))
+            else:
+                status, body = '404 Not Found', None
+        else:
+            status, body = '404 Not Found', None
+        if body is None:
+            start_response(status, [('Content-Type', 'text/plain')])
+            return [b'not found']
+        return self.respond(start_response, status, body)
+
+    def respond(self, start_response, status, body, headers=()):
+        if self.random.random() < self.malformed:
+            self.faults['malformed'] += 1
+            body = body[:len(body) // 2]
+        start_response(status, [('Content-Type', 'application/json')] + list(headers))
+        return [body]
+
+    def serve(self, port):
+        server = WSGIServer(('127.0.0.1', port), self.app, log=None)
+        server.start()
+        return server
+
+
+class NullSink:
+    """Overlay writer standing for ffmpeg, records when the overlay of each play is written"""
+
+    def __init__(self, standin):
+        self.standin = standin
+        self.game = None
+        self.frames = 0
+        self.drifts = []
+
+    def record(self):
+        self.frames += 1
+        play = getattr(self.game, 'current_play', None)
+        if self.game.game_started and play in self.standin.archive.index:
+            self.drifts.append(time.monotonic() - self.standin.published(play))
+
+    def write(self, image):
+        self.record()
+
+    def write_frame(self, frame):
+        self.record()
+
+
+def probe_stalls(stalls):
+    """Time during which the event loop was blocked, above gs.LOOP_BLOCKED_EVENT"""
+    while True:
+        start = time.monotonic()
+        gevent.sleep(gs.LOOP_PROBE_INTERVAL)
+        blocked = time.monotonic() - start - gs.LOOP_PROBE_INTERVAL
+        if blocked > gs.LOOP_BLOCKED_EVENT:
+            stalls.append(blocked)
+
+
+def sample_memory(samples, start):
+    while True:
+        samples.append((time.monotonic() - start, gs.resident_memory()))
+        gevent.sleep(1)
+
+
+def summary(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'median': values[len(values) // 2],
+        'p95': values[int(len(values) * 0.95)],
+        'max': values[-1],
+    }
+
+
+def configure(standin, working_dir, port):
+    speed = standin.speed
+    settings = gs.Settings()
+    settings.website_url = 'http://127.0.0.1:%s' % port
+    settings.wbsc_url = 'http://127.0.0.1:%s/gamedata' % port
+    settings.working_dir = working_dir
+    settings.archive_dir = os.path.join(working_dir, 'archives')
+    settings.asset_cache_dir = os.path.join(working_dir, 'assets')
+    settings.headshot_cache_dir = os.path.join(working_dir, 'headshots')
+    settings.stats_db = os.path.join(working_dir, 'stats.sqlite')
+    settings.font = ARGS['--font']
+    settings.overlay_engine = ARGS['--engine']
+    settings.mode = 'live'
+    settings.photo_workers = 0
+    # the intervals of the service follow the game clock
+    settings.poll_min_interval = max(0.05, settings.poll_min_interval / speed)
+    settings.poll_max_interval = max(0.2, settings.poll_max_interval / speed)
+    settings.discovery_min_interval = max(0.1, settings.discovery_min_interval / speed)
+    settings.discovery_max_interval = max(0.5, settings.discovery_max_interval / speed)
+    settings.discovery_grace = max(0.5, settings.discovery_grace / speed)
+    settings.game_start_delay /= speed
+    settings.game_retry_interval /= speed
+    settings.game_end_delay /= speed
+    gs.configure(settings)
+
+
+def soak(standin, games):
+    session = gs.make_session()
+    discovery = gs.Discovery(session)
+    discovery.start()
+    start = time.monotonic()
+    stalls = []
+    samples = []
+    probes = [gevent.spawn(probe_stalls, stalls), gevent.spawn(sample_memory, samples, start)]
+    played = []
+    for number in range(games):
+        standin.restart()
+        seen, current = discovery.wait(0)
+        while not current:
+            seen, current = discovery.wait(seen)
+        sink = NullSink(standin)
+        game_start = time.monotonic()
+        game = gs.Game(current[0], mode='live', stream=False, session=session, discovery=discovery)
+        sink.game = game
+        game.overlay_writer = sink
+        gevent.joinall([gevent.spawn(game.loop_main), gevent.spawn(game.loop_check_main_website)])
+        game_memory = game.memory()
+        game.release()
+        del game
+        gc.collect()
+        # the drift is split in quarters of the game to see if it grows
+        quarter = len(sink.drifts) // 4
+        played.append({
+            'seconds': time.monotonic() - game_start,
+            'frames': sink.frames,
+            'drift_seconds': summary(sink.drifts),
+            'drift_first_quarter_seconds': statistics.mean(sink.drifts[:quarter]) if quarter else None,
+            'drift_last_quarter_seconds': statistics.mean(sink.drifts[-quarter:]) if quarter else None,
+            'game_memory_bytes': game_memory,
+            'resident_bytes_after_release': gs.resident_memory(),
+        })
+        logging.info('Game %s of %s over, %s frames', number + 1, games, sink.frames)
+    gevent.killall(probes)
+    discovery.stop()
+    after = [game['resident_bytes_after_release'] for game in played]
+    duration = (standin.archive.times[-1] - standin.archive.times[0]) / 1000 / 3600
+    return {
+        'games': played,
+        'memory': {
+            'resident_start_bytes': samples[0][1] if samples else None,
+            'resident_max_bytes': max(rss for _, rss in samples) if samples else None,
+            'resident_end_bytes': after[-1],
+            # growth of the memory left once a game is released, per game after the first one
+            'growth_per_game_bytes': (after[-1] - after[0]) / (len(after) - 1) if len(after) > 1 else None,
+            'growth_per_game_hour_bytes': (samples[-1][1] - samples[0][1]) / (duration * games) if samples else None,
+        },
+        'stalls': {
+            'count': len(stalls),
+            'total_seconds': sum(stalls),
+            'max_seconds': max(stalls, default=0),
+        },
+    }
+
+
+def main():
+    archive = gs.GameArchive(ARGS['<archive>'] or os.path.join(DIRECTORY, 'fixtures', 'sample_game.wbsc'))
+    port = int(ARGS['--port'])
+    standin = StandIn(archive, float(ARGS['--speed']), latency=float(ARGS['--latency']),
+                      errors=float(ARGS['--errors']), malformed=float(ARGS['--malformed']), seed=int(ARGS['--seed']))
+    server = standin.serve(port)
+    if ARGS['serve']:
+        print('website_url = http://127.0.0.1:%s\nwbsc_url = http://127.0.0.1:%s/gamedata' % (port, port))
+        while True:
+            standin.restart()
+            while not standin.over:
+                gevent.sleep(1)
+    working_dir = tempfile.mkdtemp(prefix='soak_scoreboard_')
+    try:
+        configure(standin, working_dir, port)
+        results = {
+            'archive': os.path.basename(archive.path),
+            'speed': standin.speed,
+            'engine': ARGS['--engine'],
+            'game_hours': (archive.times[-1] - archive.times[0]) / 1000 / 3600,
+            'faults': {'latency': standin.latency, 'errors': standin.errors, 'malformed': standin.malformed},
+        }
+        results.update(soak(standin, int(ARGS['--games'])))
+        results['injected'] = standin.faults
+        results['requests'] = standin.requests
+    finally:
+        server.stop()
+        archive.close()
+        shutil.rmtree(working_dir, ignore_errors=True)
+    output = json.dumps(results, indent=2)
+    if ARGS['--output']:
+        with open(ARGS['--output'], 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    ARGS = docopt(__doc__)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -0,0 +1,730 @@
+import configparser
+import copy
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+import types
+from io import BytesIO
+
+import gevent
+import gevent.socket
+import gevent.subprocess
+import numpy
+import pytest
+import requests
+from PIL import Image
+from gevent.fileobject import FileObjectPosix
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import generate_scoreboard as gs  # noqa: E402
+
+
+class FakeResponse:
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self.data = data
+        self.headers = {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError('%s' % self.status_code)
+
+    def json(self):
+        return self.data
+
+
+class FakeSession:
+    """latest.json and play<n>.json of wbsc, the plays in failing answer a 503"""
+
+    def __init__(self, latest, failing=()):
+        self.latest = latest
+        self.failing = set(failing)
+
+    def get(self, url, headers=None, timeout=None):
+        name = url.rsplit('/', 1)[-1]
+        if name == 'latest.json':
+            return FakeResponse(200, self.latest)
+        play = int(name[len('play'):-len('.json')])
+        if play in self.failing:
+            return FakeResponse(503)
+        return FakeResponse(200, {'play': play})
+
+
+def test_poll_stops_at_the_first_failed_play():
+    session = FakeSession(latest=6, failing={4})
+    ingest = gs.LiveIngest(session, 1000)
+
+    plays = ingest.poll(1)
+    assert [play for play, data in plays] == [2, 3]
+
+    session.failing.clear()
+    plays = ingest.poll(plays[-1][0])
+    assert [play for play, data in plays] == [4, 5, 6]
+
+
+def test_poll_without_new_play():
+    ingest = gs.LiveIngest(FakeSession(latest=6, failing={7}), 1000)
+    assert ingest.poll(6) == []
+
+
+def scheduler(monkeypatch, cpus, max_games, warm_standby=False, encoder_cpus=0):
+    monkeypatch.setattr(gs.settings, 'warm_standby', warm_standby)
+    monkeypatch.setattr(gs.settings, 'encoder_cpus', encoder_cpus)
+    return gs.Scheduler(max_games=max_games, budget=gs.CpuBudget(range(cpus)))
+
+
+def test_single_game_is_not_pinned(monkeypatch):
+    assert scheduler(monkeypatch, cpus=1, max_games=1, warm_standby=True).game_cpus == 0
+
+
+def test_games_share_the_cpu_budget(monkeypatch):
+    assert scheduler(monkeypatch, cpus=4, max_games=2).game_cpus == 2
+    assert scheduler(monkeypatch, cpus=4, max_games=2, warm_standby=True, encoder_cpus=1).game_cpus == 2
+    assert scheduler(monkeypatch, cpus=2, max_games=2, warm_standby=True).game_cpus == 2
+
+
+class FailingAssets:
+    def get(self, session, url, timeout=None):
+        raise AssertionError('%s downloaded again' % url)
+
+
+def test_get_image_does_not_download_an_asset_given_up_by_the_prefetch(monkeypatch):
+    monkeypatch.setattr(gs, 'ASSETS', FailingAssets())
+    game = types.SimpleNamespace(assets={'http://logo': None}, session=None)
+    assert gs.Game.get_image(game, 'http://logo') is None
+    assert game.assets == {'http://logo': None}
+
+
+def test_stats_seeded_from_an_export_give_the_same_line():
+    entry = {'playerid': 7, 'teamid': 1, 'PA': '3', 'AB': '3', 'H': '2', 'HR': '1', 'SEASON': {'AB': '10', 'H': '4'}}
+    service = gs.StatsStore(':memory:')
+    service.update('event', 1, [entry])
+    worker = gs.StatsStore(':memory:')
+    worker.seed(service.export('event'))
+    assert worker.line('event', 1, 7) == service.line('event', 1, 7)
+    assert worker.line('event', 1, 7)['ab'] == 13
+
+
+def test_season_line_is_the_latest_season_of_wbsc_and_the_current_game():
+    stats = gs.StatsStore(':memory:')
+    # game 1 was streamed, game 2 was not, the SEASON of game 3 includes both
+    stats.update('event', 1, [{'playerid': 7, 'AB': '4', 'H': '2', 'SEASON': {'AB': '10', 'H': '3'}}])
+    stats.update('event', 3, [{'playerid': 7, 'AB': '1', 'H': '1', 'SEASON': {'AB': '18', 'H': '6'}}])
+    line = stats.line('event', 3, 7)
+    assert (line['ab'], line['h']) == (19, 7)
+    assert line['avg'] == 7 / 19
+    assert line['slg'] == 7 / 19 and line['obp'] == 7 / 19
+
+    stats.update('event', 3, [{'playerid': 7, 'AB': '2', 'H': '1', 'HR': '1', 'SEASON': {'AB': '18', 'H': '6'}}])
+    line = stats.line('event', 3, 7)
+    assert (line['ab'], line['h'], line['hr']) == (20, 7, 1)
+    assert line['slg'] == 10 / 20
+
+
+def test_derived_lines_of_batters_and_pitchers():
+    stats = gs.StatsStore(':memory:')
+    stats.update('event', 1, [
+        {'playerid': 7, 'AB': '3', 'H': '2', 'DOUBLE': '1', 'BB': '1', 'HBP': '1', 'SF': '1',
+         'SEASON': {'AB': '7', 'H': '2', 'TRIPLE': '1', 'HR': '1'}},
+        {'playerid': 8, 'PITCHES': '40', 'STRIKES': '26', 'BALLS': '14', 'SEASON': {}},
+    ])
+    line = stats.line('event', 1, 7)
+    assert line['avg'] == 4 / 10
+    assert line['obp'] == (4 + 1 + 1) / (10 + 1 + 1 + 1)
+    assert line['slg'] == (4 + 1 + 2 + 3) / 10
+    line = stats.line('event', 1, 8)
+    assert line['strike_pct'] == 65.0
+    assert line['avg'] == line['obp'] == line['slg'] == 0.0
+    assert stats.line('event', 1, 9)['strike_pct'] == 0.0
+
+
+def test_webhook_is_not_exposed_without_token(monkeypatch):
+    monkeypatch.setattr(gs.settings, 'discovery', 'webhook')
+    monkeypatch.setattr(gs.settings, 'discovery_webhook_host', '0.0.0.0')
+    monkeypatch.setattr(gs.settings, 'discovery_token', None)
+    discovery = gs.Discovery(FakeSession(latest=1))
+    monkeypatch.setattr(discovery, 'run_poll', lambda: None)
+    discovery.start()
+    try:
+        assert discovery.server is None and not discovery.pushed
+    finally:
+        discovery.stop()
+
+
+class ArchiveSession(FakeSession):
+    """Plays of wbsc, the plays in malformed answer a truncated json"""
+
+    def __init__(self, latest, malformed=()):
+        super().__init__(latest)
+        self.malformed = set(malformed)
+        self.fetched = []
+
+    def get(self, url, headers=None, timeout=None):
+        name = url.rsplit('/', 1)[-1]
+        if name == 'latest.json':
+            return FakeResponse(200, self.latest)
+        play = int(name[len('play'):-len('.json')])
+        self.fetched.append(play)
+        response = FakeResponse(200, {'playdata': [{'t': play * 1000}], 'situation': {'currentinning': 'TOP 1'}})
+        if play in self.malformed:
+            response.json = lambda: json.loads('{"playdata": [')
+        return response
+
+
+def test_incomplete_archive_is_completed_on_next_use(tmp_path):
+    path = str(tmp_path / '1000.wbsc')
+    session = ArchiveSession(latest=5, malformed={3})
+    gs.GameArchive.download(session, 1000, path).close()
+
+    session.malformed.clear()
+    session.fetched.clear()
+    archive = gs.GameArchive.open(session, 1000, path)
+    assert session.fetched == [3]
+    assert archive.plays == [1, 2, 3, 4, 5] and archive.missing == []
+    archive.close()
+
+    session.fetched.clear()
+    gs.GameArchive.open(session, 1000, path).close()
+    assert session.fetched == []
+
+
+FIXTURE = os.path.join(ROOT, 'fixtures', 'sample_game.wbsc')
+GAME_INFO = {
+    'home_primary_color': '#0a14c8',
+    'home_secondary_color': '#c8c800',
+    'away_primary_color': '#dcdcdc',
+    'away_secondary_color': '#000000',
+}
+
+
+@pytest.fixture
+def configured(tmp_path, monkeypatch):
+    """Service configured to replay the archives of tmp_path"""
+    parser = configparser.ConfigParser()
+    parser['baseball'] = {
+        'working_dir': str(tmp_path),
+        'mode': 'replay',
+        'replay_mode': 'sequence',
+        'font': '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+        'photo_workers': '0',
+    }
+    for name in ('settings', 'ASSETS', 'PHOTOS', 'IMAGES', 'STATS', 'FIELDS'):
+        monkeypatch.setattr(gs, name, getattr(gs, name))
+    gs.configure(gs.Settings(parser))
+    yield gs.settings
+    gs.STATS.close()
+    gs.get_font.cache_clear()
+    gs.fit_font.cache_clear()
+
+
+def replay_game(game_id):
+    game = gs.Game(dict(GAME_INFO, live_score_id=game_id), mode='replay', replay_mode='sequence', stream=False)
+    game.replay.stop()
+    return game
+
+
+def lineups(game):
+    return [
+        (team.pitcher.id, [(player.id, player.lineupcode, player.position, player.pa, player.h, player.pitches)
+                           for player in team.get_lineup()])
+        for team in (game.home, game.away)
+    ] + [game.pitcher.id, game.batter.id]
+
+
+def test_delta_boxscore_update_gives_the_lineups_of_a_full_rebuild(configured):
+    archive = gs.GameArchive(FIXTURE)
+    first = archive.read(archive.plays[100])
+    archive.close()
+    second = copy.deepcopy(first)
+    boxscore = second['boxscore']
+    # pitching change of the fielding team, the new pitcher comes after the previous one in the boxscore
+    boxscore['2001'] = dict(boxscore['2000'], playerid=2051, name='Pitch Er21', lastname='Er21',
+                            PITCHIP='0.0', PITCHES=1, STRIKES=1, BALLS=0)
+    boxscore['2000']['PITCHIP'] = '2.1'
+    second['situation']['pitcherid'] = 2051
+    # pinch hitter for the batter, who leaves the boxscore
+    boxscore['1041'] = dict(boxscore.pop('1040'), playerid=1011, name='Pinch Hitter', lastname='Hitter', POS='PH', PA=0, AB=0, H=0)
+    second['situation']['batterid'] = 1011
+    boxscore['1010']['H'] += 1
+    gs.GameArchive.write(gs.GameArchive.path_for(4242), 4242, {1: first, 2: second})
+
+    delta = replay_game(4242)
+    delta.update_game(second)
+    configured.replay_start = 'play:2'
+    rebuild = replay_game(4242)
+
+    assert lineups(delta) == lineups(rebuild)
+    assert delta.pitcher.id == 2051 and delta.batter.id == 1011
+    assert 1004 not in delta.away.lineup and 1004 not in delta.home.lineup
+
+
+def test_prerender_worker_reuses_the_headshots_of_the_service(configured, monkeypatch, tmp_path):
+    archive = gs.GameArchive(FIXTURE)
+    play = archive.read(archive.plays[0])
+    archive.close()
+    play['boxscore']['1010']['image'] = 'http://photos/1001.jpg'
+    gs.GameArchive.write(gs.GameArchive.path_for(4242), 4242, {1: play})
+    path = str(tmp_path / 'headshot.png')
+    Image.new('RGBA', (10, 10)).save(path)
+    monkeypatch.setattr(gs, 'ASSETS', FailingAssets())
+
+    game = gs.Game(dict(GAME_INFO, live_score_id=4242), mode='replay', replay_mode='sequence', stream=False,
+                   headshots={'http://photos/1001.jpg': path})
+    game.replay.stop()
+    game.photo_loaders.join()
+    assert game.game_started
+    team = game.home if game.home.id == 10 else game.away
+    assert team.all_players[1001].image.size == (10, 10)
+
+
+def ts_packet(pid, payload=b'', start=False, keyframe=False):
+    header = bytes([0x47, (0x40 if start else 0) | pid >> 8, pid & 0xff])
+    if keyframe:
+        # adaptation field with the random access indicator
+        header += bytes([0x30, 1, 0x40])
+    else:
+        header += bytes([0x10])
+    return (header + payload).ljust(gs.TsScanner.PACKET_SIZE, b'\xff')
+
+
+PAT = ts_packet(0, bytes([0, 0x00, 0xb0, 13, 0, 1, 0xc1, 0, 0, 0, 1, 0xf0, 0x00, 0, 0, 0, 0]), start=True)
+PMT = ts_packet(0x1000, bytes([0, 0x02, 0xb0, 18, 0, 1, 0xc1, 0, 0, 0xe1, 0x00, 0xf0, 0x00,
+                               0x1b, 0xe1, 0x00, 0xf0, 0x00, 0, 0, 0, 0]), start=True)
+
+
+def video(keyframe=False):
+    return ts_packet(0x100, b'\0\0\1\xe0', start=True, keyframe=keyframe)
+
+
+def test_stream_switch_changes_source_at_a_keyframe():
+    switch = gs.StreamSwitch({'encoder': 1, 'slate': 2}, [3])
+    switch.select('encoder')
+    assert switch.receive('encoder', PAT + PMT + video()) is None
+    assert switch.receive('encoder', video(keyframe=True)) == PAT + PMT + video(keyframe=True)
+    assert switch.receive('encoder', video()) == video()
+
+    switch.select('slate')
+    assert switch.receive('slate', PAT + PMT + video()) is None
+    assert switch.receive('encoder', video()) == video()
+    # the packets of the previous group of pictures in the datagram are dropped
+    assert switch.receive('slate', video() + video(keyframe=True) + video()) == PAT + PMT + video(keyframe=True) + video()
+    assert switch.active == 'slate'
+    assert switch.receive('encoder', video(keyframe=True)) is None
+
+
+def test_audio_keyframes_do_not_switch_the_source():
+    switch = gs.StreamSwitch({'encoder': 1, 'slate': 2}, [3])
+    switch.select('slate')
+    assert switch.receive('slate', PAT + PMT + ts_packet(0x101, b'\0\0\1\xc0', start=True, keyframe=True)) is None
+    assert switch.active is None
+
+
+def test_stalled_overlay_pipe_does_not_hold_the_others():
+    writer = gs.OverlayPipeWriter((64, 64))
+    stalled = writer.ffmpeg_input()[1][0]
+    reading = writer.ffmpeg_input()[1][0]
+    reader = FileObjectPosix(reading, 'rb', bufsize=0)
+    size = 64 * 64 * 4
+    received = []
+
+    def read():
+        while True:
+            received.append(reader.read(size))
+
+    greenlet = gevent.spawn(read)
+    try:
+        # far more than the pipe buffer of the stalled ffmpeg
+        for _ in range(40):
+            writer.push()
+            gevent.sleep(0.001)
+        assert len(received) >= 30
+    finally:
+        greenlet.kill()
+        writer.close()
+        reader.close()
+        os.close(stalled)
+
+
+def test_overlay_frame_is_not_changed_by_the_next_overlay():
+    pytest.importorskip('numpy')
+    canvas = gs.NumpyCanvas((4, 2))
+    writer = gs.OverlayPipeWriter((4, 2))
+    red = Image.new('RGBA', (4, 2), (255, 0, 0, 255))
+    canvas.begin()
+    canvas.paste(red, (0, 0))
+    canvas.commit()
+    canvas.write(writer)
+    frame = writer.frame
+    # the next overlays are composed in both frames of the canvas
+    for color in ((0, 255, 0, 255), (0, 0, 255, 255)):
+        canvas.begin()
+        canvas.clear()
+        canvas.paste(Image.new('RGBA', (4, 2), color), (0, 0))
+        canvas.commit()
+    assert bytes(frame) == red.tobytes()
+    assert canvas.image.tobytes() == Image.new('RGBA', (4, 2), (0, 0, 255, 255)).tobytes()
+
+
+def test_fit_font_is_the_biggest_font_narrower_than_the_width(configured):
+    text = 'LASTNAMEVERYLONG3 F.'
+    font = gs.fit_font(text, 300, 40)
+    assert font.getlength(text) < 300 <= gs.get_font(font.size + 1).getlength(text)
+    assert gs.fit_font('F', 300, 40).size == 39
+    assert gs.fit_font(text, 300, 40) is font
+
+
+def compositor(drawn, scale=1.5):
+    def fill(draw, state):
+        draw.rectangle((0, 0, 100, 50), fill=state)
+
+    def disc(draw, state):
+        box, color = state
+        drawn.append(state)
+        draw.ellipse(box, fill=color)
+
+    return gs.Compositor(gs.Layer((0, 0, 100, 50), lambda game: game.background, fill, scale), [
+        gs.Layer((5, 5, 45, 45), lambda game: ((5, 5, 45, 45), game.left), disc, scale),
+        gs.Layer((55, 5, 95, 45), lambda game: ((55, 5, 95, 45), game.right), disc, scale),
+    ])
+
+
+def test_compositor_only_redraws_the_changed_layers_like_a_full_redraw():
+    game = types.SimpleNamespace(background=(0, 0, 200, 255), left=(255, 0, 0, 128), right=(0, 255, 0, 128))
+    drawn = []
+    component = compositor(drawn)
+    assert component.compose(game)
+    assert not component.compose(game)
+
+    drawn.clear()
+    game.left = (255, 255, 0, 128)
+    assert component.compose(game)
+    assert drawn == [((5, 5, 45, 45), game.left)]
+    full = compositor([])
+    full.compose(game)
+    assert component.image.size == (150, 75)
+    assert component.image.tobytes() == full.image.tobytes()
+
+    game.background = (0, 100, 0, 255)
+    component.compose(game)
+    full = compositor([])
+    full.compose(game)
+    assert component.image.tobytes() == full.image.tobytes()
+
+
+def test_numpy_blend_matches_pil_alpha_composite():
+    random = numpy.random.default_rng(1)
+    target = random.integers(0, 256, (64, 64, 4), dtype=numpy.uint8)
+    source = random.integers(0, 256, (64, 64, 4), dtype=numpy.uint8)
+    # faint, transparent and opaque pixels on both sides
+    target[:8, :, 3] = 0
+    target[8:16, :, 3] = 1
+    source[16:24, :, 3] = 0
+    source[24:32, :, 3] = 255
+    expected = numpy.asarray(Image.alpha_composite(Image.fromarray(target, 'RGBA'), Image.fromarray(source, 'RGBA'))).astype(int)
+    gs.NumpyCanvas.blend(target, source)
+    difference = numpy.abs(target.astype(int) - expected)
+    assert difference[..., 3].max() <= 1
+    assert difference[..., :3][expected[..., 3] > 0].max() <= 1
+
+
+def ffmpeg_stand_in(script):
+    """Process printing -progress reports like ffmpeg"""
+    return gevent.subprocess.Popen(['sh', '-c', script], stdout=gevent.subprocess.PIPE, universal_newlines=True)
+
+
+def test_supervisor_restarts_a_stalled_process_with_backoff(monkeypatch):
+    monkeypatch.setattr(gs.settings, 'stall_timeout', 0.3)
+    monkeypatch.setattr(gs.settings, 'restart_backoff', 0.2)
+    monkeypatch.setattr(gs.settings, 'restart_backoff_max', 0.4)
+    starts = []
+
+    def spawn():
+        starts.append(time.monotonic())
+        # one frame, then no progress
+        return ffmpeg_stand_in('echo frame=1; echo progress=continue; exec sleep 30')
+
+    supervisor = gs.Supervisor('stalled', spawn)
+    supervisor.start()
+    try:
+        gevent.sleep(0.1)
+        assert supervisor.healthy
+        with gevent.Timeout(5):
+            while len(starts) < 4:
+                gevent.sleep(0.05)
+    finally:
+        supervisor.stop()
+    # stall_timeout then 0.2, 0.4 and 0.4 seconds of backoff
+    gaps = [after - before for before, after in zip(starts, starts[1:])]
+    assert gaps[0] == pytest.approx(0.5, abs=0.15)
+    assert gaps[1] == pytest.approx(0.7, abs=0.15)
+    assert gaps[2] == pytest.approx(0.7, abs=0.15)
+    assert supervisor.proc.wait(timeout=1) is not None
+
+
+def test_supervisor_keeps_a_process_making_progress(monkeypatch):
+    monkeypatch.setattr(gs.settings, 'stall_timeout', 0.3)
+    starts = []
+
+    def spawn():
+        starts.append(time.monotonic())
+        return ffmpeg_stand_in('i=0; while true; do i=$((i+1)); echo frame=$i; echo progress=continue; sleep 0.05; done')
+
+    supervisor = gs.Supervisor('running', spawn)
+    supervisor.start()
+    try:
+        gevent.sleep(1)
+        assert supervisor.healthy and len(starts) == 1
+    finally:
+        supervisor.stop()
+
+
+def test_scheduler_starts_games_within_the_fields_and_cpus(configured, monkeypatch):
+    gs.FIELDS['camera2'].main_stream = 'rtmp://127.0.0.1/field2'
+    games = scheduler(monkeypatch, cpus=3, max_games=2, encoder_cpus=2)
+    started = []
+    monkeypatch.setattr(games, 'run_game', lambda game_info, field, cpus: started.append((game_info['live_score_id'], field.camera, cpus)))
+
+    games.schedule({'live_score_id': 1, 'camera': 'camera1'})
+    games.schedule({'live_score_id': 2, 'camera': 'camera1'})
+    # a free field but only one CPU left
+    games.schedule({'live_score_id': 3, 'camera': 'camera2'})
+    gevent.sleep(0)
+    assert started == [(1, 'camera1', [0, 1])]
+
+    # the game of camera1 is over
+    del games.games['camera1']
+    games.budget.release([0, 1])
+    games.schedule({'live_score_id': 3, 'camera': 'camera2'})
+    gevent.sleep(0)
+    assert started[1:] == [(3, 'camera2', [0, 1])]
+
+
+def test_scheduler_does_not_stream_two_games_to_the_same_channel(configured, monkeypatch):
+    gs.FIELDS['camera1'].main_stream = gs.FIELDS['camera2'].main_stream = 'rtmp://127.0.0.1/live'
+    games = scheduler(monkeypatch, cpus=4, max_games=2)
+    started = []
+    monkeypatch.setattr(games, 'run_game', lambda game_info, field, cpus: started.append(field.camera))
+    games.schedule({'live_score_id': 1, 'camera': 'camera1'})
+    games.schedule({'live_score_id': 2, 'camera': 'camera2'})
+    gevent.sleep(0)
+    assert started == ['camera1']
+
+
+def test_render_ahead_draws_the_next_pitch_but_not_an_unlikely_play(configured, monkeypatch):
+    os.makedirs(configured.archive_dir)
+    shutil.copy(FIXTURE, gs.GameArchive.path_for(1000))
+    configured.replay_start = 'play:12'
+    archive = gs.GameArchive(FIXTURE)
+    ball = archive.read(13)
+    archive.close()
+    hits = []
+    draw = gs.Layer.draw
+
+    def recording(layer, state, background=None):
+        hits.append(state in layer.rendered)
+        return draw(layer, state, background)
+
+    monkeypatch.setattr(gs.Layer, 'draw', recording)
+
+    def next_play(data):
+        game = replay_game(1000)
+        game.make_overlay()
+        game.render_ahead()
+        hits.clear()
+        game.update_game(data)
+        game.current_play = 13
+        game.make_overlay()
+        return hits
+
+    assert next_play(ball) and all(hits)
+    # two outs on a single pitch are not rendered ahead
+    unlikely = copy.deepcopy(ball)
+    unlikely['situation']['outs'] = 2
+    assert False in next_play(unlikely)
+
+
+def test_metrics_in_the_prometheus_text_format():
+    metrics = gs.Metrics()
+    metrics.inc('stream_restarts_total', process='encoder')
+    metrics.inc('stream_restarts_total', process='encoder')
+    metrics.set('image_pool_bytes', 100)
+    metrics.observe('render_seconds', 0.5, event=False, component='scorebug')
+    metrics.observe('render_seconds', 0.25, event=False, component='scorebug')
+    assert metrics.render().splitlines() == [
+        '# TYPE stream_restarts_total counter',
+        'stream_restarts_total{process="encoder"} 2',
+        '# TYPE image_pool_bytes gauge',
+        'image_pool_bytes 100',
+        '# TYPE render_seconds summary',
+        'render_seconds_count{component="scorebug"} 2',
+        'render_seconds_sum{component="scorebug"} 0.75',
+        'render_seconds{component="scorebug",quantile="1"} 0.5',
+    ]
+    # the maximum is the one since the previous scrape
+    assert 'render_seconds{component="scorebug",quantile="1"} 0.0' in metrics.render()
+
+
+def test_image_pool_drops_the_least_recently_used_images_over_budget(monkeypatch):
+    monkeypatch.setattr(gs, 'METRICS', gs.Metrics())
+    pool = gs.ImagePool(budget=3 * 10 * 10 * 4)
+    loads = []
+
+    def load(key):
+        loads.append(key)
+        return Image.new('RGBA', (10, 10))
+
+    for key in 'abc':
+        pool.get(key, lambda: load(key))
+    pool.get('a', lambda: load('a'))
+    pool.get('d', lambda: load('d'))
+    assert list(pool.images) == ['c', 'a', 'd']
+    assert loads == ['a', 'b', 'c', 'd']
+    assert pool.size == 3 * 10 * 10 * 4
+    # an image bigger than the budget is still given
+    assert pool.get('big', lambda: Image.new('RGBA', (100, 100))).size == (100, 100)
+    assert list(pool.images) == ['big']
+
+
+class SlowAssets:
+    """Assets answering after the delay in their url, a url without delay fails"""
+
+    def get(self, session, url, timeout=None):
+        delay = url.rsplit('/', 1)[-1]
+        if not delay:
+            raise requests.ConnectionError(url)
+        gevent.sleep(float(delay))
+        return url.encode()
+
+
+def test_prefetch_gives_up_at_the_deadline(monkeypatch):
+    monkeypatch.setattr(gs, 'ASSETS', SlowAssets())
+    monkeypatch.setattr(gs.settings, 'asset_deadline', 0.3)
+    game = types.SimpleNamespace(assets={}, headshots={}, session=None)
+    urls = ['http://photo/0.1', 'http://photo/0.2', 'http://photo/5', 'http://photo/', gs.DEFAULT_IMAGE_URL]
+    start = time.monotonic()
+    gs.Game.prefetch_assets(game, urls)
+    assert time.monotonic() - start < 0.5
+    assert game.assets == {
+        'http://photo/0.1': b'http://photo/0.1',
+        'http://photo/0.2': b'http://photo/0.2',
+        'http://photo/5': None,
+        'http://photo/': None,
+    }
+
+
+def test_headshot_is_processed_once_per_photo(configured, monkeypatch, tmp_path):
+    processed = []
+    make_headshot = gs.make_headshot
+
+    def counting(content):
+        processed.append(content)
+        return make_headshot(content)
+
+    monkeypatch.setattr(gs, 'make_headshot', counting)
+    photos = gs.PhotoProcessor(str(tmp_path / 'headshots'), workers=0)
+    photo, updated = BytesIO(), BytesIO()
+    Image.new('RGB', (200, 300), 'red').save(photo, 'JPEG')
+    Image.new('RGB', (200, 300), 'blue').save(updated, 'JPEG')
+
+    image = photos.headshot('http://photos/1.jpg', photo.getvalue())
+    assert image.size == (gs.PHOTO_WIDTH, gs.PHOTO_WIDTH)
+    # a new game, or the service after a restart
+    assert gs.PhotoProcessor(str(tmp_path / 'headshots'), workers=0).headshot('http://photos/1.jpg', photo.getvalue()).size == image.size
+    assert len(processed) == 1
+    photos.headshot('http://photos/1.jpg', updated.getvalue())
+    assert processed == [photo.getvalue(), updated.getvalue()]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_standin_only_serves_the_plays_already_published():
+    port = free_port()
+    url = 'http://127.0.0.1:%s' % port
+    # at speed 1 the second play of the fixture is published after 19s
+    standin = subprocess.Popen([sys.executable, os.path.join(ROOT, 'soak_scoreboard.py'),
+                                'serve', '--speed=1', '--port=%s' % port, FIXTURE], stdout=subprocess.DEVNULL)
+    try:
+        for attempt in range(50):
+            try:
+                current = requests.get(url + '/game/current_score', timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        assert current.json()['live_score_id'] == 1000
+        assert requests.get(url + '/game/current_score', headers={'If-None-Match': current.headers['ETag']}).status_code == 304
+        assert requests.get(url + '/gamedata/1000/latest.json').json() == 1
+        assert requests.get(url + '/gamedata/1000/play1.json').json()['playdata']
+        assert requests.get(url + '/gamedata/1000/play2.json').status_code == 404
+        assert requests.get(url + '/gamedata/1001/latest.json').status_code == 404
+    finally:
+        standin.kill()
+        standin.wait()
+
+
+def test_import_has_no_side_effects(tmp_path):
+    script = '''
+import logging
+import gevent.monkey
+import generate_scoreboard
+assert not gevent.monkey.is_module_patched('socket')
+assert not logging.getLogger().handlers
+assert generate_scoreboard.PHOTOS is None and generate_scoreboard.STATS is None
+'''
+    subprocess.run([sys.executable, '-c', script], cwd=str(tmp_path), check=True, env=dict(os.environ, PYTHONPATH=ROOT))
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_switch_camera_sends_the_streamselect_commands(configured, monkeypatch, tmp_path):
+    monkeypatch.setattr(configured, 'hot_camera_switch', True)
+    prompt = open(str(tmp_path / 'prompt'), 'w')
+    # reads the commands on its stdin like the command prompt of ffmpeg
+    proc = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=prompt, universal_newlines=True)
+    game = types.SimpleNamespace(camera='camera1', encoders=[types.SimpleNamespace(name='encoder', proc=proc)])
+    game.camera_index = lambda: gs.Game.camera_index(game)
+
+    gs.Game.switch_camera(game, 'camera2')
+    gs.Game.switch_camera(game, 'camera2')
+    gs.Game.switch_camera(game, 'camera3')
+    gs.Game.switch_camera(game, 'camera1')
+    proc.stdin.close()
+    proc.wait()
+    prompt.close()
+    with open(str(tmp_path / 'prompt')) as f:
+        assert f.read() == 'cstreamselect -1 map 1\ncastreamselect -1 map 1\ncstreamselect -1 map 0\ncastreamselect -1 map 0\n'
+    assert game.camera == 'camera1'
+
+
+def test_every_relay_gets_the_single_encode(monkeypatch):
+    # the service runs with the socket module patched by gevent
+    monkeypatch.setattr(gs, 'socket', gevent.socket)
+    relays = []
+    # main and backup
+    for _ in range(2):
+        relay = gevent.socket.socket(gevent.socket.AF_INET, gevent.socket.SOCK_DGRAM)
+        relay.bind(('127.0.0.1', 0))
+        relay.settimeout(2)
+        relays.append(relay)
+    switch = gs.StreamSwitch({'encoder': free_port()}, [relay.getsockname()[1] for relay in relays])
+    switch.start()
+    switch.select('encoder')
+    encoder = gevent.socket.socket(gevent.socket.AF_INET, gevent.socket.SOCK_DGRAM)
+    try:
+        for datagram in (PAT + PMT + video(), video(keyframe=True), video()):
+            encoder.sendto(datagram, ('127.0.0.1', switch.ports['encoder']))
+        for relay in relays:
+            assert relay.recv(65536) == PAT + PMT + video(keyframe=True)
+            assert relay.recv(65536) == video()
+    finally:
+        switch.stop()
+        encoder.close()
+        for relay in relays:
+            relay.close()